@@ -0,0 +1,222 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+import logging
+
+import yaml
+
+import metrics as metrics
+import ratelimit as ratelimit
+
+try:
+    config = yaml.safe_load(open('config.yaml'))
+except yaml.YAMLError as exc:
+    print(exc)
+
+# Gap backfill ################################################################
+# Tweets posted while a stream connection is down are never delivered. The
+# listener checkpoints the newest status id it has seen from every followed
+# account; when a connection is lost the checkpoints for its accounts are
+# put aside, and once it is back up each of those accounts' timelines is
+# fetched since its checkpoint. The fetches run concurrently, drawing on a
+# token bucket so they stay within the user_timeline rate limit, and the
+# tweets found are handed to the listener oldest first, through the same
+# filter, render and dedup steps as the stream, in the backfill thread so
+# they are posted in that order. Tweets that also arrived on the stream are
+# dropped by the listener's dedup.
+#
+# Besides the bucket, which spreads the calls out, no more than
+# `window_calls` are made in any 15 minutes, whatever the bucket settings.
+#
+# Accounts without a checkpoint (never seen yet) are not backfilled, and
+# tweets older than `max_age` seconds are skipped so a long outage doesn't
+# flood the channels with old news.
+
+# user_timeline returns at most 200 tweets per call
+TIMELINE_COUNT = 200
+# user_timeline allows 900 calls per user per 15 minute window
+TIMELINE_LIMIT = 900
+TIMELINE_WINDOW = 15 * 60
+# Twitter's epoch for status ids, in milliseconds
+SNOWFLAKE_EPOCH = 1288834974657
+
+BACKFILLED = metrics.counter('backfill_tweets_total', 'Tweets found by gap backfill')
+BACKFILL_TIME = metrics.histogram('backfill_seconds', 'Time to backfill after a reconnect',
+                                  buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                                           60.0, 120.0, 300.0, 900.0))
+
+def status_time(status_id):
+    """When a status was posted (unix time), from its id"""
+    return ((int(status_id) >> 22) + SNOWFLAKE_EPOCH) / 1000.0
+
+class Checkpoints:
+    """Newest status id seen from each followed account"""
+
+    def __init__(self, file=None):
+        self.file = file
+        self.lock = Lock()
+        self.entries = {}
+        if file:
+            self.load()
+
+    def update(self, user_id, status_id):
+        status_id = int(status_id)
+        with self.lock:
+            if status_id > self.entries.get(user_id, 0):
+                self.entries[user_id] = status_id
+
+    def get(self, user_id):
+        return self.entries.get(user_id)
+
+    def snapshot(self, ids):
+        """{user id: checkpoint} for the ids that have one"""
+        with self.lock:
+            return {user_id: self.entries[user_id] for user_id in ids
+                    if user_id in self.entries}
+
+    def load(self):
+        if not os.path.exists(self.file):
+            return
+        try:
+            with open(self.file, 'r') as f:
+                self.entries = {k: int(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError) as e:
+            logging.error("Could not read checkpoints %s: %s", self.file, e)
+
+    def save(self):
+        if not self.file:
+            return
+        with self.lock:
+            data = json.dumps(self.entries)
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, self.file)
+
+_checkpoints = None
+_checkpoints_lock = Lock()
+
+def get_checkpoints():
+    """
+    Return the process wide checkpoints, shared by every listener
+    so a restart backfills from where the last one stopped
+    """
+    global _checkpoints
+    with _checkpoints_lock:
+        if _checkpoints is None:
+            _checkpoints = Checkpoints(config.get('checkpoint_file') or None)
+    return _checkpoints
+
+class Backfiller:
+    """Fetch what followed accounts posted while a stream was down"""
+
+    def __init__(self, api, handle, checkpoints, workers=8, rate=0.66, burst=300,
+                 max_age=3600, window_calls=TIMELINE_LIMIT, clock=time.time):
+        # handle(data) for every tweet payload found, oldest first
+        self.api = api
+        self.handle = handle
+        self.checkpoints = checkpoints
+        self.workers = workers
+        self.max_age = max_age
+        self.clock = clock
+        self.bucket = ratelimit.TokenBucket(rate, burst)
+        self.window = ratelimit.WindowLimit(window_calls, TIMELINE_WINDOW)
+        self.bucket_lock = Lock()
+        self.lock = Lock()
+        # checkpoints put aside when a stream was lost, by stream name
+        self.gaps = {}
+
+        # counters
+        self.runs = 0
+        self.requests = 0
+        self.found = 0
+        self.errors = 0
+
+    def lost(self, name, ids):
+        """A stream following ids went down"""
+        with self.lock:
+            # after several failures in a row the gap starts at the first one
+            if name not in self.gaps:
+                self.gaps[name] = self.checkpoints.snapshot(ids)
+
+    def recovered(self, name, ids):
+        """A stream following ids is connected again, backfill in the background"""
+        with self.lock:
+            since = self.gaps.pop(name, None)
+        if since is None:
+            # first connection: the gap since the last run
+            since = self.checkpoints.snapshot(ids)
+        else:
+            wanted = set(ids)
+            since = {user_id: s for user_id, s in since.items() if user_id in wanted}
+        if since:
+            Thread(target=self.run, args=(since,), daemon=True,
+                   name='{}-backfill'.format(name)).start()
+
+    def _take(self):
+        """Wait for a rate limit token"""
+        while True:
+            with self.bucket_lock:
+                now = time.monotonic()
+                # only take a token once the window has room for the call
+                wait = self.window.wait(now) or self.bucket.take(now)
+                if not wait:
+                    self.window.record(now)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _fetch(self, item):
+        user_id, since_id = item
+        self._take()
+        # fetches run on several threads, and runs for several streams at once
+        with self.lock:
+            self.requests += 1
+        try:
+            statuses = self.api.user_timeline(user_id=user_id, since_id=since_id,
+                                              count=TIMELINE_COUNT, tweet_mode='extended')
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            logging.error("Backfill failed for user %s: %s", user_id, e)
+            return []
+        if len(statuses) >= TIMELINE_COUNT:
+            logging.warning("Backfill for user %s found a full page, older tweets are missed",
+                            user_id)
+        return [status._json for status in statuses]
+
+    def run(self, since):
+        """
+        Fetch every account's timeline since its checkpoint in `since`
+        ({user id: status id}) and hand the tweets on, returns the number found
+        """
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pages = list(pool.map(self._fetch, since.items()))
+        oldest = self.clock() - self.max_age
+        tweets = [data for page in pages for data in page
+                  if status_time(data['id']) >= oldest]
+        # status ids grow with time
+        tweets.sort(key=lambda data: data['id'])
+        for data in tweets:
+            try:
+                self.handle(data)
+            except Exception as e:
+                logging.error("Error handling backfilled tweet: %s", e)
+        elapsed = time.monotonic() - start
+        with self.lock:
+            self.runs += 1
+            self.found += len(tweets)
+        BACKFILLED.inc(len(tweets))
+        BACKFILL_TIME.observe(elapsed)
+        logging.info("Backfilled %d tweets from %d accounts in %.2fs",
+                     len(tweets), len(since), elapsed)
+        self.checkpoints.save()
+        return len(tweets)
+
+    def stats(self):
+        return {'runs': self.runs, 'requests': self.requests,
+                'found': self.found, 'errors': self.errors,
+                'pending_gaps': len(self.gaps)}
@@ -1,6 +1,11 @@
 import csv
+import os
+import sqlite3
+import sys
+import time
 import yaml
 from pathlib import Path
+from threading import Lock, Thread, local
 import logging
 
 try:
@@ -10,79 +15,414 @@ except yaml.YAMLError as exc:
 
 keyword_file = config['keyword_file']
 user_file = config['user_file']
+route_file = config.get('route_file', 'routes.csv')
+# seconds between checks for changes made by other processes
+cache_refresh = config.get('cache_refresh', 1.0)
+# 'csv' (the files above) or 'sqlite' (db_file)
+storage = config.get('storage', 'csv')
+db_file = config.get('db_file', 'bot.db')
 
-def get_keywords(file=keyword_file):
-    """Return a list of Twitter topics the bot is following"""
+# In-memory snapshots #########################################################
+# Parsed CSV contents are cached as immutable snapshots. A background thread
+# stats the files every `cache_refresh` seconds and swaps in a new snapshot
+# when the mtime, size or inode changes, so readers never touch the disk
+# after the first load and writes from server.py show up within that delay.
+# With the SQLite backend the sources are 'sqlite:<table>' and the stamp is
+# the table's change version instead.
+
+class Snapshot:
+    """Immutable parsed contents of a CSV file"""
+    __slots__ = ('items', 'set', 'stamp')
+
+    def __init__(self, items, stamp):
+        self.items = tuple(items)
+        self.set = frozenset(self.items)
+        self.stamp = stamp
+
+_snapshots = {}
+_snapshot_lock = Lock()
+_refresher = None
 
+def _stamp(file):
+    if file.startswith(SQLITE_PREFIX):
+        return table_version(file[len(SQLITE_PREFIX):])
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+# one item per line, taken literally so keyword queries keep their quotes.
+# Older versions quoted items containing a comma or a quote when writing.
+# Such a keyword now reads back as a quoted phrase query, which matches the
+# same words; users are unquoted by _read_users
+LINES = dict(delimiter='\n', quoting=csv.QUOTE_NONE, quotechar=None)
+
+def _read_csv(file):
+    """Parse a one-item-per-line CSV file, creating it if it is missing"""
     if not Path(file).exists():
         with open(file, "w") as my_empty_csv:
-            logging.info('Creating new users file')
-            pass  
+            logging.info('Creating new file %s', file)
+            pass
 
     with open(file, 'r') as csvfile:
-        spamreader = csv.reader(csvfile, delimiter='\n')
-        keywords = []
+        spamreader = csv.reader(csvfile, **LINES)
+        items = []
         for row in spamreader:
             for item in row:
-                keywords.append(item)
-    return list(filter(lambda a: a != '', keywords))
+                items.append(item)
+    return list(filter(lambda a: a != '', items))
+
+def _unquote(item):
+    if len(item) >= 2 and item[0] == item[-1] == '"':
+        return item[1:-1].replace('""', '"')
+    return item
+
+def _read_users(file):
+    """_read_csv for a users file, dropping quotes older versions wrote"""
+    # handles never contain quotes, the next add or remove rewrites them
+    return [_unquote(user) for user in _read_csv(file)]
+
+def _read_rows(file):
+    """Parse a CSV file of (channel, term) rows, creating it if it is missing"""
+    if not Path(file).exists():
+        with open(file, "w") as my_empty_csv:
+            logging.info('Creating new file %s', file)
+            pass
+
+    with open(file, 'r') as csvfile:
+        return [tuple(row[:2]) for row in csv.reader(csvfile) if len(row) >= 2]
+
+# file -> parser used to (re)load its snapshot
+_parsers = {}
+
+def _load(file):
+    stamp = _stamp(file)
+    parse = _parsers.get(file, _read_csv)
+    snapshot = Snapshot(parse(file), stamp or _stamp(file))
+    _snapshots[file] = snapshot
+    return snapshot
+
+def _refresh_loop():
+    while True:
+        time.sleep(cache_refresh)
+        for file, snapshot in list(_snapshots.items()):
+            try:
+                if _stamp(file) != snapshot.stamp:
+                    logging.debug('reloading changed file %s', file)
+                    with _snapshot_lock:
+                        _load(file)
+            except (OSError, sqlite3.Error) as e:
+                logging.error('Could not reload %s: %s', file, e)
+
+def get_snapshot(file, parse=None):
+    """Return the cached snapshot for file, loading it on first use"""
+    global _refresher
+    snapshot = _snapshots.get(file)
+    if snapshot is not None:
+        return snapshot
+    with _snapshot_lock:
+        if parse is not None:
+            _parsers[file] = parse
+        snapshot = _snapshots.get(file)
+        if snapshot is None:
+            snapshot = _load(file)
+        if _refresher is None:
+            _refresher = Thread(target=_refresh_loop, daemon=True)
+            _refresher.start()
+    return snapshot
+
+def invalidate(file=None):
+    """Force a reload of file (or every cached file) on the next read"""
+    with _snapshot_lock:
+        if file is None:
+            _snapshots.clear()
+        else:
+            _snapshots.pop(file, None)
+
+def keyword_set(file=None):
+    """Return a frozenset of the keywords the bot is searching for"""
+    return get_snapshot(source('keywords', file)).set
+
+def user_set(file=None):
+    """Return a frozenset of the Twitter users the bot is following"""
+    return get_snapshot(source('users', file)).set
+
+# SQLite backend ##############################################################
+# One row per user/keyword/route with primary keys for indexed membership
+# checks. Every write runs in an IMMEDIATE transaction that also bumps the
+# table's version in `meta`, so other processes can poll a single integer
+# instead of watching files. WAL mode lets the stream process read while the
+# control server writes.
+
+SQLITE_PREFIX = 'sqlite:'
+TABLES = {'users': 'handle', 'keywords': 'keyword'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (handle TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS keywords (keyword TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS routes (channel TEXT NOT NULL, term TEXT NOT NULL,
+                                   PRIMARY KEY (channel, term));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+
+_local = local()
+
+def connect(file=None):
+    """Return this thread's connection to the database, creating it if needed"""
+    file = file or db_file
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.file != file:
+        new = not Path(file).exists()
+        conn = sqlite3.connect(file, timeout=5.0, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        _local.conn, _local.file = conn, file
+        if new:
+            migrate_csv(conn)
+    return conn
+
+def _write(sql, params, kind):
+    """Run a write in its own transaction, bumping kind's version if it changed anything"""
+    conn = connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        changed = conn.execute(sql, params).rowcount
+        if changed:
+            conn.execute('INSERT INTO meta (key, value) VALUES (?, 1) '
+                         'ON CONFLICT(key) DO UPDATE SET value = value + 1', (kind,))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    invalidate(SQLITE_PREFIX + kind)
+    return changed
 
-def add_keyword(keyword, file=keyword_file):
+def table_version(kind):
+    """Change counter for one table, cheap enough to poll"""
+    row = connect().execute('SELECT value FROM meta WHERE key = ?', (kind,)).fetchone()
+    return row[0] if row else 0
+
+def change_version():
+    """Change counter covering every table"""
+    row = connect().execute('SELECT COALESCE(SUM(value), 0) FROM meta').fetchone()
+    return row[0]
+
+def _read_table(key):
+    kind = key[len(SQLITE_PREFIX):]
+    if kind == 'routes':
+        sql = 'SELECT channel, term FROM routes ORDER BY rowid'
+        return [tuple(row) for row in connect().execute(sql)]
+    sql = 'SELECT {} FROM {} ORDER BY rowid'.format(TABLES[kind], kind)
+    return [row[0] for row in connect().execute(sql)]
+
+def migrate_csv(conn=None):
+    """Copy the users, keywords and routes CSV files into the database"""
+    conn = conn or connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for kind, file in (('users', user_file), ('keywords', keyword_file)):
+            if Path(file).exists():
+                items = _read_csv(file)
+                conn.executemany('INSERT OR IGNORE INTO {} VALUES (?)'.format(kind),
+                                 [(item,) for item in items])
+                logging.info('migrated %d %s from %s', len(items), kind, file)
+        if Path(route_file).exists():
+            conn.executemany('INSERT OR IGNORE INTO routes VALUES (?, ?)',
+                             _read_rows(route_file))
+        for kind in ('users', 'keywords', 'routes'):
+            conn.execute('INSERT INTO meta (key, value) VALUES (?, 1) '
+                         'ON CONFLICT(key) DO UPDATE SET value = value + 1', (kind,))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+def source(kind, file=None):
+    """
+    Where kind ('users', 'keywords' or 'routes') is stored: an explicit
+    file, the configured CSV file or the SQLite table
+    """
+    if file is not None:
+        if kind == 'users':
+            _parsers[file] = _read_users
+        return file
+    if storage == 'sqlite':
+        key = SQLITE_PREFIX + kind
+        _parsers[key] = _read_table
+        return key
+    if kind == 'routes':
+        _parsers[route_file] = _read_rows
+        return route_file
+    if kind == 'users':
+        _parsers[user_file] = _read_users
+    return {'users': user_file, 'keywords': keyword_file}[kind]
+
+def watch_changes(interval=None):
+    """Yield the set of kinds changed since the last check, forever"""
+    kinds = ('users', 'keywords', 'routes')
+    versions = {kind: _stamp(source(kind)) for kind in kinds}
+    while True:
+        time.sleep(interval or cache_refresh)
+        changed = set()
+        for kind in kinds:
+            version = _stamp(source(kind))
+            if version != versions[kind]:
+                versions[kind] = version
+                changed.add(kind)
+        if changed:
+            yield changed
+
+def kinds_for_paths(paths):
+    """Map changed file paths (e.g. from watchgod) to the kinds stored in them"""
+    names = {os.path.basename(path) for path in paths}
+    return {kind for kind, file in (('users', user_file),
+                                    ('keywords', keyword_file),
+                                    ('routes', route_file))
+            if os.path.basename(file) in names}
+
+###############################################################################
+
+def get_keywords(file=None):
+    """Return a list of Twitter topics the bot is following"""
+    return list(get_snapshot(source('keywords', file)).items)
+
+def add_keyword(keyword, file=None):
     """Add a Twitter keyword to the keyword.csv file to follow"""
+    if file is None and storage == 'sqlite':
+        if _write('INSERT OR IGNORE INTO keywords VALUES (?)', (keyword,), 'keywords'):
+            logging.info('adding %s to keywords table', keyword)
+        return
+    file = file or keyword_file
     keywords = get_keywords(file)
     if keyword not in keywords:
-        with open(file, 'a') as csvfile:    
-            spamwriter = csv.writer(csvfile)
+        with open(file, 'a') as csvfile:
+            spamwriter = csv.writer(csvfile, **LINES)
             spamwriter.writerow([keyword])
-            logging.info('adding {} to keywords file'.format(keyword))
+            logging.info('adding %s to keywords file', keyword)
+        invalidate(file)
 
-def remove_keyword(keyword, file=keyword_file):
+def remove_keyword(keyword, file=None):
     """Add a Twitter user to follow file"""
+    if file is None and storage == 'sqlite':
+        if _write('DELETE FROM keywords WHERE keyword = ?', (keyword,), 'keywords'):
+            logging.info('removing %s from keywords table', keyword)
+        return
+    file = file or keyword_file
     keywords = get_keywords(file)
     if keyword in keywords:
         keywords.remove(keyword)
         # write new keyword file
-        logging.info('removing {} from keywords file'.format(keyword))
+        logging.info('removing %s from keywords file', keyword)
         with open(file, 'w') as csvfile:
-            spamwriter = csv.writer(csvfile, delimiter='\n')
+            spamwriter = csv.writer(csvfile, **LINES)
             for k in keywords:
                 spamwriter.writerow([k])
+        invalidate(file)
 
-def get_users(file=user_file):
+def get_users(file=None):
     """Return a list of Twitter users the bot is following"""
-
-    if not Path(file).exists():
-        with open(file, "w") as my_empty_csv:
-            logging.info('Creating new users file')
-            pass
-
-    with open(file, 'r') as csvfile:
-        spamreader = csv.reader(csvfile, delimiter='\n')
-        users = []
-        for row in spamreader:
-            for item in row:
-                users.append(item)
-
     logging.debug('returning users in file')
-    return list(filter(lambda a: a != '', users))
+    return list(get_snapshot(source('users', file)).items)
 
-def add_user(user, file=user_file):
+def add_user(user, file=None):
     """Add a Twitter user to the CSV file to follow"""
+    if file is None and storage == 'sqlite':
+        if _write('INSERT OR IGNORE INTO users VALUES (?)', (user,), 'users'):
+            logging.info('adding %s to users table', user)
+        return
+    file = file or user_file
     users = get_users(file)
     if user not in users:
-        with open(file, 'a') as csvfile:    
-            spamwriter = csv.writer(csvfile)
+        with open(file, 'a') as csvfile:
+            spamwriter = csv.writer(csvfile, **LINES)
             spamwriter.writerow([user])
-            logging.info('adding {} to users file'.format(user))
+            logging.info('adding %s to users file', user)
+        invalidate(file)
 
-def remove_user(user, file=user_file):
+def remove_user(user, file=None):
     """Add a Twitter user to follow file"""
+    if file is None and storage == 'sqlite':
+        if _write('DELETE FROM users WHERE handle = ?', (user,), 'users'):
+            logging.info('removing %s from users table', user)
+        return
+    file = file or user_file
     users = get_users(file)
     if user in users:
         users.remove(user)
         # write new user file
-        logging.info('removing {} from users file'.format(user))
+        logging.info('removing %s from users file', user)
         with open(file, 'w') as csvfile:
-            spamwriter = csv.writer(csvfile, delimiter='\n')
+            spamwriter = csv.writer(csvfile, **LINES)
             for u in users:
                 spamwriter.writerow([u])
+        invalidate(file)
+
+def get_routes(file=None):
+    """Return {channel: [terms]} for the routing rules added from Slack"""
+    routes = {}
+    for channel, term in route_rows(file):
+        routes.setdefault(channel, []).append(term)
+    return routes
+
+def add_route(channel, terms, file=None):
+    """Route tweets matching terms ('@user' or keyword) to channel"""
+    if file is None and storage == 'sqlite':
+        conn = connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            added = conn.executemany('INSERT OR IGNORE INTO routes VALUES (?, ?)',
+                                     [(channel, term) for term in terms]).rowcount
+            if added:
+                conn.execute('INSERT INTO meta (key, value) VALUES (?, 1) '
+                             'ON CONFLICT(key) DO UPDATE SET value = value + 1',
+                             ('routes',))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        invalidate(SQLITE_PREFIX + 'routes')
+        logging.info('adding %s to route for %s', ' '.join(terms), channel)
+        return
+    file = file or route_file
+    rows = get_snapshot(file, _read_rows).set
+    with open(file, 'a') as csvfile:
+        spamwriter = csv.writer(csvfile)
+        for term in terms:
+            if (channel, term) not in rows:
+                spamwriter.writerow([channel, term])
+                logging.info('adding %s to route for %s', term, channel)
+    invalidate(file)
+
+def remove_route(channel, file=None):
+    """Remove every routing rule for channel"""
+    if file is None and storage == 'sqlite':
+        if _write('DELETE FROM routes WHERE channel = ?', (channel,), 'routes'):
+            logging.info('removing route for %s', channel)
+        return
+    file = file or route_file
+    rows = get_snapshot(file, _read_rows).items
+    if any(c == channel for c, _ in rows):
+        logging.info('removing route for %s', channel)
+        with open(file, 'w') as csvfile:
+            spamwriter = csv.writer(csvfile)
+            for row in rows:
+                if row[0] != channel:
+                    spamwriter.writerow(row)
+        invalidate(file)
+
+def route_rows(file=None):
+    """Return the cached (channel, term) routing rows as an immutable tuple"""
+    key = source('routes', file)
+    if file is not None:
+        _parsers[key] = _read_rows
+    return get_snapshot(key).items
+
+if __name__ == '__main__':
+    # python db.py migrate: copy the CSV files into the SQLite database
+    if sys.argv[1:] == ['migrate']:
+        migrate_csv()
+        print('users: {}, keywords: {}, routes: {}'.format(
+            *(connect().execute('SELECT COUNT(*) FROM ' + t).fetchone()[0]
+              for t in ('users', 'keywords', 'routes'))))
@@ -0,0 +1,105 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+import logging
+
+import yaml
+
+try:
+    config = yaml.safe_load(open('config.yaml'))
+except yaml.YAMLError as exc:
+    print(exc)
+
+# Duplicate suppression #######################################################
+# When several followed accounts retweet or quote the same status we only
+# want to post it once. The cache maps a canonical status id to the time it
+# was last posted, bounded by both age (`window` seconds) and `capacity`.
+
+class DedupCache:
+    """Bounded TTL/LRU set of recently posted status ids"""
+
+    def __init__(self, window=3600, capacity=10000, file=None):
+        self.window = window
+        self.capacity = capacity
+        self.file = file
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if file:
+            self.load()
+
+    def seen(self, key, now=None):
+        """
+        Return True if key was seen within the window, otherwise
+        remember it and return False
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            stamp = self.entries.get(key)
+            if stamp is not None and now - stamp < self.window:
+                self.hits += 1
+                return True
+            # entries stay ordered by time so eviction only looks at the front
+            self.entries[key] = now
+            self.entries.move_to_end(key)
+            self.misses += 1
+            self._evict(now)
+            return False
+
+    def _evict(self, now):
+        entries = self.entries
+        while len(entries) > self.capacity:
+            entries.popitem(last=False)
+        # oldest first, stop at the first entry still inside the window
+        while entries:
+            key, stamp = next(iter(entries.items()))
+            if now - stamp < self.window:
+                break
+            entries.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits,
+                'misses': self.misses}
+
+    def load(self):
+        if not os.path.exists(self.file):
+            return
+        try:
+            with open(self.file, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error("Could not read dedup cache %s: %s", self.file, e)
+            return
+        with self.lock:
+            self.entries = OrderedDict(sorted(entries.items(), key=lambda kv: kv[1]))
+            self._evict(time.time())
+
+    def save(self):
+        if not self.file:
+            return
+        with self.lock:
+            data = json.dumps(self.entries)
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, self.file)
+
+_cache = None
+_cache_lock = Lock()
+
+def get_cache():
+    """
+    Return the process wide cache, shared by every listener so a
+    reconnect doesn't post the same statuses again
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DedupCache(window=config.get('dedup_window', 3600),
+                                capacity=config.get('dedup_capacity', 10000),
+                                file=config.get('dedup_file') or None)
+    return _cache
@@ -0,0 +1,211 @@
+import multiprocessing
+import os
+import time
+from threading import Event, Lock, Thread
+import logging
+
+import db as db
+import ingest as ingest
+import log as log
+import metrics as metrics
+import record as record
+import routing as routing
+import slack as slack
+
+# Multiprocess filtering ######################################################
+# The filter threads share the GIL, so decoding, matching and rendering can
+# only ever use one core. In multiprocess mode the stream reader does the
+# cheap author check and hands the raw payloads to `processes` worker
+# processes, sharded by author id so each account's tweets stay in order.
+# Every worker keeps its own router, rebuilt when the users, keywords or
+# routes change, and sends back only the matches, already rendered, for the
+# parent to dedup and pass to the single Slack sender.
+#
+# Payloads are sent in batches of up to `batch_size`, anything waiting is
+# flushed every `flush_interval` seconds.
+#
+# This only pays off with several cores. Every payload is pickled over to a
+# worker and every match back, and on one core the processes just take
+# turns with the stream process: on a single CPU `replay.py --processes 1,2`
+# ran at 0.35x and 0.24x of the in-thread speed. It hasn't been measured on
+# a multi-core machine yet, check there with --processes before enabling it.
+
+RELOAD = 'reload'
+
+REJECTED = metrics.counter('tweets_rejected_total',
+                           'Tweets dropped, by the filter stage that dropped them',
+                           ('stage',))
+RENDERED = metrics.counter('tweets_rendered_total', 'Slack messages rendered')
+
+def _run_shard(shard, channel, inbox, results, level):
+    """Worker process main loop"""
+    log.setup_child_logging(results, level)
+    results.put(('ready', shard, None))
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            break
+        if batch == RELOAD:
+            db.invalidate()
+            continue
+        router = routing.get_router(channel)
+        keyword_matcher = None if router.any_keyword else router.matcher
+        rejected = {}
+        matches = []
+        for raw in batch:
+            try:
+                data = ingest.loads(raw)
+                reason = ingest.content_reject_reason(data, keyword_matcher)
+                if reason is not None:
+                    rejected[reason] = rejected.get(reason, 0) + 1
+                    continue
+                tweet = record.TweetRecord.from_dict(data)
+                channels = router.route(tweet)
+                if channels:
+                    matches.append((sorted(channels), tweet.canonical_id,
+                                    slack.build_message(tweet), tweet.user_icon))
+            except Exception as e:
+                logging.error("Error filtering tweet in shard %d: %s", shard, e)
+        results.put(('batch', shard, (len(batch), rejected, matches)))
+    results.put(('done', shard, None))
+
+class FilterPool:
+    """Worker processes filtering and rendering raw tweet payloads"""
+
+    def __init__(self, handler, processes=2, channel=None, batch_size=50,
+                 flush_interval=0.05):
+        # handler(channels, canonical_id, blocks, user_icon) for each match
+        self.handler = handler
+        self.processes = processes
+        self.channel = channel
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self.stopping = Event()
+        self.buffers = [[] for _ in range(processes)]
+        self.workers = []
+        self.inboxes = []
+
+        # counters
+        self.submitted = 0
+        self.processed = 0
+        self.matched = 0
+        self.rejected = {}
+
+    def start(self, timeout=60):
+        """Start the workers and wait until they are all ready"""
+        # spawn so the workers don't inherit the sender and logging threads
+        ctx = multiprocessing.get_context('spawn')
+        self.results = ctx.Queue()
+        level = logging.getLogger().getEffectiveLevel()
+        for shard in range(self.processes):
+            inbox = ctx.Queue()
+            worker = ctx.Process(target=_run_shard, daemon=True,
+                                 name='filter-{}'.format(shard),
+                                 args=(shard, self.channel, inbox,
+                                       self.results, level))
+            worker.start()
+            self.inboxes.append(inbox)
+            self.workers.append(worker)
+
+        ready = 0
+        deadline = time.monotonic() + timeout
+        while ready < self.processes:
+            item = self.results.get(timeout=max(0, deadline - time.monotonic()))
+            if isinstance(item, logging.LogRecord):
+                log.handle_child_record(item)
+            elif item[0] == 'ready':
+                ready += 1
+        logging.info("Started %d filter processes", self.processes)
+        if (os.cpu_count() or 1) < 2:
+            logging.warning("Filter processes on a single CPU are slower than "
+                            "filtering in threads, set filter_processes to 0")
+        metrics.gauge('filter_backlog', 'Payloads sent to filter processes and not yet back',
+                      fn=lambda: self.submitted - self.processed)
+
+        self._collector = Thread(target=self._collect, daemon=True,
+                                 name='filter-results')
+        self._collector.start()
+        self._flusher = Thread(target=self._flush_loop, daemon=True,
+                               name='filter-flush')
+        self._flusher.start()
+        return self
+
+    def submit(self, raw, author_id):
+        """Queue a raw payload for the shard that owns author_id"""
+        shard = int(author_id) % self.processes
+        with self.lock:
+            buffer = self.buffers[shard]
+            buffer.append(raw)
+            self.submitted += 1
+            if len(buffer) >= self.batch_size:
+                self.inboxes[shard].put(buffer)
+                self.buffers[shard] = []
+
+    def flush(self):
+        """Send every partly filled batch"""
+        with self.lock:
+            for shard, buffer in enumerate(self.buffers):
+                if buffer:
+                    self.inboxes[shard].put(buffer)
+                    self.buffers[shard] = []
+
+    def _flush_loop(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+
+    def reload(self):
+        """Have every worker reread the users, keywords and routes"""
+        self.flush()
+        for inbox in self.inboxes:
+            inbox.put(RELOAD)
+
+    def _collect(self):
+        done = 0
+        while done < self.processes:
+            item = self.results.get()
+            if isinstance(item, logging.LogRecord):
+                log.handle_child_record(item)
+                continue
+            kind, shard, payload = item
+            if kind == 'done':
+                done += 1
+                continue
+            count, rejected, matches = payload
+            self.processed += count
+            self.matched += len(matches)
+            for reason, n in rejected.items():
+                self.rejected[reason] = self.rejected.get(reason, 0) + n
+                REJECTED.labels(reason).inc(n)
+            RENDERED.inc(len(matches))
+            for match in matches:
+                try:
+                    self.handler(*match)
+                except Exception as e:
+                    logging.error("Error handling filtered tweet: %s", e)
+
+    def stats(self):
+        return {'processes': self.processes,
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'matched': self.matched,
+                'backlog': self.submitted - self.processed,
+                'rejected': dict(self.rejected)}
+
+    def stop(self, timeout=10):
+        """
+        Finish everything already submitted and stop the workers,
+        returns True if they all exited in time
+        """
+        self.stopping.set()
+        self.flush()
+        for inbox in self.inboxes:
+            inbox.put(None)
+        deadline = time.monotonic() + timeout
+        self._collector.join(timeout)
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        stuck = [w for w in self.workers if w.is_alive()]
+        for worker in stuck:
+            worker.terminate()
+        return not stuck and not self._collector.is_alive()
@@ -0,0 +1,55 @@
+import json
+
+import record as record
+
+try:
+    # orjson is optional but decodes stream payloads several times faster
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Raw payload checks ##########################################################
+# The follow stream mostly delivers replies and retweets of our accounts by
+# other users. These checks work on the decoded dict so those payloads can
+# be thrown away before any tweepy model objects are built.
+
+def is_tweet(data):
+    """Stream payloads that are tweets (not deletes, limits, warnings...)"""
+    return 'in_reply_to_status_id' in data
+
+def raw_texts(data):
+    """The texts the keyword filter searches, straight from the payload"""
+    texts = [record.full_text(data)]
+    for key in ('quoted_status', 'retweeted_status'):
+        nested = data.get(key)
+        if nested:
+            texts.append(record.full_text(nested))
+    return texts
+
+def author_id(data):
+    """The author's id as a string, as it appears in the follow list"""
+    user = data.get('user') or {}
+    return user.get('id_str', str(user.get('id')))
+
+def status_id(data):
+    """The tweet's id as a string"""
+    return data.get('id_str') or str(data.get('id'))
+
+def reject_reason(data, follow_ids, keyword_matcher=None):
+    """
+    Return why a tweet payload can be dropped early ('user', 'reply' or
+    'keyword'), or None if it should go through the full pipeline
+    """
+    if author_id(data) not in follow_ids:
+        return 'user'
+    return content_reject_reason(data, keyword_matcher)
+
+def content_reject_reason(data, keyword_matcher=None):
+    """reject_reason without the author check, for already sorted payloads"""
+    if data.get('in_reply_to_status_id') is not None:
+        return 'reply'
+    if keyword_matcher is not None and \
+            not keyword_matcher.match_any(raw_texts(data)):
+        return 'keyword'
+    return None
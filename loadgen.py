@@ -0,0 +1,137 @@
+"""
+Load generator for the slash command control server.
+
+Runs server.create_app() on a local port next to a stand-in for Slack's
+response_url, then sends signed slash commands from many concurrent
+clients and reports how long the acknowledgement took (Slack allows 3 s)
+and how long until the reply reached the response_url.
+
+    python loadgen.py                          # 1000 /help commands, 200 at a time
+    python loadgen.py -n 5000 -c 500 --command /users
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+import logging
+from urllib.parse import urlencode
+
+import aiohttp
+from aiohttp import web
+
+# the server reads the secret at import, any value works for a local run
+os.environ.setdefault('SLACK_SIGNING_SECRET', 'loadgen')
+import server as server
+
+def sign(body, timestamp):
+    """X-Slack-Signature for body, as Slack computes it"""
+    base = 'v0:{}:'.format(timestamp).encode() + body
+    return 'v0=' + hmac.new(server.SLACK_SIGNING_SECRET.encode(), base,
+                            hashlib.sha256).hexdigest()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def summary(seconds):
+    ms = [s * 1e3 for s in seconds]
+    return {'p50_ms': percentile(ms, 50), 'p90_ms': percentile(ms, 90),
+            'p99_ms': percentile(ms, 99), 'max_ms': max(ms) if ms else 0.0}
+
+async def run(commands, concurrency, command, text, timeout=60):
+    sent = {}
+    acked = {}
+    replied = {}
+    errors = []
+    done = asyncio.Event()
+
+    # stand-in for Slack's response_url
+    async def response_url(request):
+        i = int(request.match_info['i'])
+        replied[i] = time.perf_counter() - sent[i]
+        if len(replied) == commands:
+            done.set()
+        return web.Response()
+
+    sink = web.Application()
+    sink.router.add_post('/response/{i}', response_url)
+    runners = []
+    urls = []
+    for app in (server.create_app(), sink):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        runners.append(runner)
+        host, port = runner.addresses[0][:2]
+        urls.append('http://{}:{}'.format(host, port))
+    command_url = urls[0] + '/slack/events'
+    reply_url = urls[1] + '/response/'
+
+    slots = asyncio.Semaphore(concurrency)
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=concurrency))
+
+    async def send(i):
+        body = urlencode({'command': command, 'text': text,
+                          'response_url': reply_url + str(i)}).encode()
+        timestamp = str(int(time.time()))
+        headers = {'X-Slack-Request-Timestamp': timestamp,
+                   'X-Slack-Signature': sign(body, timestamp),
+                   'Content-Type': 'application/x-www-form-urlencoded'}
+        async with slots:
+            sent[i] = time.perf_counter()
+            try:
+                async with session.post(command_url, data=body,
+                                        headers=headers) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        errors.append(resp.status)
+                acked[i] = time.perf_counter() - sent[i]
+            except aiohttp.ClientError as e:
+                errors.append(str(e))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(commands)))
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+
+    await session.close()
+    for runner in runners:
+        await runner.cleanup()
+
+    return {'commands': commands, 'concurrency': concurrency,
+            'command': command, 'seconds': elapsed,
+            'commands_per_second': len(replied) / elapsed,
+            'errors': len(errors) + commands - len(replied),
+            'ack': summary(list(acked.values())),
+            'reply': summary(list(replied.values()))}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--commands', type=int, default=1000,
+                        help='number of slash commands to send')
+    parser.add_argument('-c', '--concurrency', type=int, default=200,
+                        help='commands in flight at once')
+    parser.add_argument('--command', default='/help',
+                        help='slash command to send, read-only ones are safest')
+    parser.add_argument('--text', default='', help='slash command text')
+    args = parser.parse_args(argv)
+
+    # keep the per-command info logging out of the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args.commands, args.concurrency,
+                             args.command, args.text))
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+import sys
+import time
+
+import yaml
+
+try:
+    config = yaml.safe_load(open('config.yaml'))
+except yaml.YAMLError as exc:
+    print(exc)
+
+# Logging setup ###############################################################
+# Log calls only format the record and put it on a queue. A QueueListener
+# thread does the JSON formatting and the (rotating) file writes, so worker
+# threads never wait on the disk or the handler lock. Always pass arguments
+# (logging.info("x %s", y)) rather than pre-formatting the message so
+# disabled levels cost a level check and nothing else.
+
+# attributes every LogRecord has, anything else was passed in `extra`
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def __init__(self, process_name):
+        super(JsonFormatter, self).__init__()
+        self.process_name = process_name
+
+    def format(self, record):
+        data = {'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                        + '.%03dZ' % record.msecs,
+                'level': record.levelname,
+                'process': self.process_name,
+                'thread': record.threadName,
+                'logger': record.name,
+                'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _RESERVED:
+                data[key] = value
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Keeps the traceback apart from the message for JsonFormatter"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def log_level(argv=None):
+    """The level from --log=LEVEL on the command line, else config.yaml"""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--log', default=config.get('log_level', 'INFO'))
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    level = logging.getLevelName(args.log.upper())
+    if not isinstance(level, int):
+        raise ValueError("Unknown log level: {}".format(args.log))
+    return level
+
+_listener = None
+
+def setup_logging(process_name, argv=None):
+    """
+    Send the root logger through a queue to a background writer with
+    JSON output and size based rotation
+    """
+    global _listener
+    # spawned worker processes re-import the main module, they log through
+    # their parent instead (setup_child_logging)
+    if _listener is not None or multiprocessing.parent_process() is not None:
+        return
+    filename = config.get('log_file', '{process}.log').format(
+        process=process_name.lower())
+    handler = logging.handlers.RotatingFileHandler(
+        filename,
+        maxBytes=config.get('log_max_bytes', 10 * 1024 * 1024),
+        backupCount=config.get('log_backups', 5))
+    handler.setFormatter(JsonFormatter(process_name))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [_QueueHandler(log_queue)]
+    root.setLevel(log_level(argv))
+
+    _listener = logging.handlers.QueueListener(log_queue, handler,
+                                               respect_handler_level=True)
+    _listener.start()
+    # flush whatever is still queued on the way out
+    atexit.register(_listener.stop)
+
+def setup_child_logging(log_queue, level=logging.INFO):
+    """
+    Log from a worker process by sending records to the parent through
+    log_queue, the parent passes them on with handle_child_record
+    """
+    root = logging.getLogger()
+    root.handlers = [_QueueHandler(log_queue)]
+    root.setLevel(level)
+
+def handle_child_record(record):
+    logging.getLogger().handle(record)
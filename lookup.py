@@ -0,0 +1,186 @@
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import logging
+
+import yaml
+
+try:
+    config = yaml.safe_load(open('config.yaml'))
+except yaml.YAMLError as exc:
+    print(exc)
+
+id_cache_file = config.get('id_cache_file', 'user_ids.json')
+id_cache_ttl = config.get('id_cache_ttl', 7 * 24 * 60 * 60)
+
+# Twitter's users/lookup endpoint takes at most 100 screen names per call
+LOOKUP_BATCH = 100
+LOOKUP_WORKERS = 4
+
+class IdCache:
+    """Persistent handle -> Twitter id cache with a time to live"""
+
+    def __init__(self, file=id_cache_file, ttl=id_cache_ttl):
+        self.file = file
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if not self.file or not os.path.exists(self.file):
+            return
+        try:
+            with open(self.file, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error("Could not read id cache %s: %s", self.file, e)
+            self.entries = {}
+
+    def save(self):
+        if not self.file:
+            return
+        with self.lock:
+            data = json.dumps(self.entries)
+        # write then rename so a crash never leaves a half written cache
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, self.file)
+
+    def get(self, handle, now=None, stale=False):
+        """The cached id, None if missing or expired unless stale is set"""
+        entry = self.entries.get(handle.lstrip('@').lower())
+        if entry is None:
+            return None
+        user_id, resolved_at = entry
+        if not stale and (now or time.time()) - resolved_at > self.ttl:
+            return None
+        return user_id
+
+    def put(self, handle, user_id, now=None):
+        with self.lock:
+            self.entries[handle.lstrip('@').lower()] = [user_id, now or time.time()]
+
+def _lookup_batch(api, names):
+    """
+    Resolve one batch of screen names, returning {lowercase name: id},
+    or None if the lookup failed
+    """
+    try:
+        users = api.lookup_users(screen_names=names)
+    except Exception as e:
+        logging.error("User lookup failed for %d handles: %s", len(names), e)
+        return None
+    return {user.screen_name.lower(): str(user.id) for user in users}
+
+def resolve_ids(handles, api, cache=None,
+                batch_size=LOOKUP_BATCH, max_workers=LOOKUP_WORKERS):
+    """
+    Return the Twitter ids for handles (with or without a leading '@'),
+    preserving order. Cached ids are reused, the rest are looked up in
+    concurrent batches and handles that can't be resolved are skipped.
+    If a lookup fails, expired ids from the cache are used instead.
+    """
+    if cache is None:
+        cache = IdCache(file=None)
+
+    now = time.time()
+    missing = []
+    failed = set()
+    for handle in handles:
+        if cache.get(handle, now) is None:
+            missing.append(handle.lstrip('@'))
+
+    if missing:
+        logging.info("Resolving %d new handles", len(missing))
+        batches = [missing[i:i + batch_size]
+                   for i in range(0, len(missing), batch_size)]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for batch, found in zip(batches, pool.map(lambda b: _lookup_batch(api, b),
+                                                      batches)):
+                if found is None:
+                    failed.update(name.lower() for name in batch)
+                    continue
+                for name, user_id in found.items():
+                    cache.put(name, user_id, now)
+        cache.save()
+
+    ids = []
+    for handle in handles:
+        user_id = cache.get(handle, now)
+        if user_id is None and handle.lstrip('@').lower() in failed:
+            # better an id that may be out of date than not following at all
+            user_id = cache.get(handle, now, stale=True)
+            if user_id is not None:
+                logging.warning("Using the expired cached id for %s", handle)
+        if user_id is None:
+            logging.warning("Could not resolve Twitter user %s", handle)
+        else:
+            ids.append(user_id)
+    return ids
+
+# Self check ##################################################################
+
+class _StubUser:
+    def __init__(self, screen_name, user_id):
+        self.screen_name = screen_name
+        self.id = user_id
+
+class StubAPI:
+    """Stands in for tweepy.API.lookup_users, `fail` makes every call raise"""
+
+    def __init__(self, users, fail=False):
+        self.users = {name.lower(): (name, user_id) for name, user_id in users.items()}
+        self.fail = fail
+        self.calls = []
+
+    def lookup_users(self, screen_names):
+        self.calls.append(list(screen_names))
+        if self.fail:
+            raise RuntimeError('lookup failed')
+        return [_StubUser(*self.users[name.lower()]) for name in screen_names
+                if name.lower() in self.users]
+
+def check():
+    """resolve_ids against a stubbed API: batching, caching, TTL and failures"""
+    users = {'user{}'.format(i): 1000 + i for i in range(250)}
+    handles = ['@' + name for name in users] + ['@missing']
+    cache = IdCache(file=None, ttl=60)
+    api = StubAPI(users)
+
+    # 251 handles go out in batches of 100, in order, unknown ones skipped
+    ids = resolve_ids(handles, api, cache)
+    assert ids == [str(i) for i in users.values()], ids[:3]
+    assert sorted(len(c) for c in api.calls) == [51, 100, 100], api.calls
+
+    # cached ids are reused, only the unknown handle is looked up again
+    api.calls = []
+    assert resolve_ids(handles, api, cache) == ids
+    assert api.calls == [['missing']], api.calls
+
+    # expired entries are looked up again
+    now = time.time()
+    for name in users:
+        cache.put(name, cache.get(name, stale=True), now - 120)
+    api.calls = []
+    assert resolve_ids(handles[:10], api, cache) == ids[:10]
+    assert api.calls == [[h.lstrip('@') for h in handles[:10]]], api.calls
+
+    # a failed lookup falls back to the expired ids
+    for name in users:
+        cache.put(name, cache.get(name, stale=True), now - 120)
+    assert resolve_ids(handles, StubAPI(users, fail=True), cache) == ids
+    # and never-resolved handles are still skipped
+    assert resolve_ids(['@new'], StubAPI(users, fail=True), cache) == []
+    print('lookup check passed')
+
+if __name__ == '__main__':
+    # python lookup.py check
+    if sys.argv[1:] == ['check']:
+        # the failures are expected, keep the output to the result
+        logging.getLogger().setLevel(logging.CRITICAL)
+        check()
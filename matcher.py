@@ -0,0 +1,93 @@
+import logging
+
+import query as query
+
+# Compiled keyword matching ###################################################
+# Every keyword (a plain keyword or a query, see query.py) is compiled once
+# into a plan. Plans are indexed by their anchor words, so a text is split
+# into words once and only the plans anchored on one of those words are
+# evaluated, against that same token stream. Plans that can't be anchored
+# (e.g. "NOT hiring") are evaluated for every text.
+
+class KeywordMatcher:
+    """Match tweet text against a fixed list of keywords"""
+
+    def __init__(self, keywords, stats=None):
+        # stats (a query.TermStats) orders the plans' terms, by default
+        # the counts in term_stats_file
+        if stats is None:
+            stats = query.get_term_stats()
+        self.keywords = frozenset(keywords)
+        self.plans = {}
+        self.by_anchor = {}
+        self.unanchored = []
+        for keyword in self.keywords:
+            try:
+                plan = query.compile(keyword, stats)
+            except query.QueryError as e:
+                # one bad entry shouldn't stop the rest from matching
+                logging.error("Skipping keyword %r: %s", keyword, e)
+                continue
+            self.plans[keyword] = plan
+            if plan.anchors is None:
+                self.unanchored.append(keyword)
+            else:
+                for anchor in plan.anchors:
+                    self.by_anchor.setdefault(anchor, []).append(keyword)
+
+    def _candidates(self, stream):
+        """Keywords whose plans could match the token stream"""
+        by_anchor = self.by_anchor
+        candidates = set(self.unanchored)
+        for key in stream.keys:
+            keywords = by_anchor.get(key)
+            if keywords:
+                candidates.update(keywords)
+        return candidates
+
+    def match(self, text):
+        """Return True if any keyword matches text"""
+        if not text:
+            return False
+        stream = query.TokenStream(text)
+        plans = self.plans
+        for keyword in self._candidates(stream):
+            if plans[keyword].evaluate(stream):
+                return True
+        return False
+
+    def match_any(self, texts):
+        """Return True if any of the texts matches a keyword"""
+        for text in texts:
+            if self.match(text):
+                return True
+        return False
+
+    def find_all(self, texts):
+        """Return the set of keywords matching any of the texts"""
+        found = set()
+        plans = self.plans
+        for text in texts:
+            if not text:
+                continue
+            stream = query.TokenStream(text)
+            for keyword in self._candidates(stream) - found:
+                if plans[keyword].evaluate(stream):
+                    found.add(keyword)
+        return found
+
+_matcher = KeywordMatcher(())
+
+def get_matcher(keywords):
+    """
+    Return a compiled matcher for keywords, only rebuilding
+    the index when the keyword list has changed
+    """
+    global _matcher
+    matcher = _matcher
+    # db snapshots hand out the same frozenset until the file changes
+    if matcher.keywords is not keywords and matcher.keywords != keywords:
+        matcher = KeywordMatcher(keywords)
+        # swapping the reference is atomic so readers never see a half built index
+        _matcher = matcher
+    return matcher
@@ -0,0 +1,236 @@
+import bisect
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import logging
+
+# Metrics #####################################################################
+# Counters, gauges and histograms kept in process and served in the
+# Prometheus text format. Recording is an index lookup and an add under a
+# lock, so instrumenting a tweet costs well under a microsecond per call.
+# Gauges for things that already keep their own count (queue depths) take a
+# function that is only called when the metrics are scraped.
+#
+#   received = metrics.counter('tweets_received_total', 'Payloads from the stream')
+#   received.inc()
+#   stage = metrics.histogram('stage_seconds', 'Time per stage', ('stage',))
+#   stage.labels('render').observe(elapsed)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from 10us (a filter pass) to 10s (a slow Slack post)
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+                   5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.children = OrderedDict()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """The child for one combination of label values"""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("{} takes labels {}".format(self.name, self.labelnames))
+            with self.lock:
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, child in list(self.children.items()):
+            lines.extend(self._samples(values, child))
+        return lines
+
+class _Value:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def _samples(self, values, child):
+        yield '{}{} {}'.format(self.name, _labels(self.labelnames, values),
+                               _number(child.value))
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. With `fn` the value is read when the
+    metrics are scraped: a number, or {label value(s): number}
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        self.fn = fn
+        super(Gauge, self).__init__(name, help, labelnames)
+
+    def _child(self):
+        return _Value()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def render(self):
+        if self.fn is None:
+            return super(Gauge, self).render()
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} gauge'.format(self.name)]
+        try:
+            value = self.fn()
+        except Exception as e:
+            logging.error("Could not read gauge %s: %s", self.name, e)
+            return lines
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for values, v in items:
+            if not isinstance(values, tuple):
+                values = (values,)
+            lines.append('{}{} {}'.format(self.name, _labels(self.labelnames, values),
+                                          _number(v)))
+        return lines
+
+    def _samples(self, values, child):
+        yield '{}{} {}'.format(self.name, _labels(self.labelnames, values),
+                               _number(child.value))
+
+class _Buckets:
+    __slots__ = ('upper', 'counts', 'sum', 'lock')
+
+    def __init__(self, upper):
+        self.upper = upper
+        self.counts = [0] * (len(upper) + 1)
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.upper, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, help, labelnames)
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _samples(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        cumulative = 0
+        for upper, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield '{}_bucket{} {}'.format(
+                self.name,
+                _labels(self.labelnames, values, 'le="{}"'.format(_number(upper))),
+                cumulative)
+        labels = _labels(self.labelnames, values)
+        yield '{}_sum{} {}'.format(self.name, labels, repr(total))
+        yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+# Registry ####################################################################
+
+_metrics = OrderedDict()
+_lock = Lock()
+
+def _register(cls, name, *args, **kwargs):
+    """Return the metric called name, creating it on first use"""
+    with _lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError("{} is already a {}".format(name, metric.kind))
+    return metric
+
+def counter(name, help, labelnames=()):
+    return _register(Counter, name, help, labelnames)
+
+def gauge(name, help, labelnames=(), fn=None):
+    metric = _register(Gauge, name, help, labelnames)
+    if fn is not None:
+        # the latest owner (e.g. a new listener after a restart) reports
+        metric.fn = fn
+    return metric
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help, labelnames, buckets=buckets)
+
+def render():
+    """Every metric in the Prometheus text format"""
+    lines = []
+    for metric in list(_metrics.values()):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics: " + format, *args)
+
+def start_server(port, host='127.0.0.1'):
+    """Serve /metrics on host:port from a background thread"""
+    httpd = ThreadingHTTPServer((host, port), _Handler)
+    httpd.daemon_threads = True
+    Thread(target=httpd.serve_forever, daemon=True, name='metrics').start()
+    logging.info("Serving metrics on http://%s:%d/metrics", host, httpd.server_address[1])
+    return httpd
@@ -0,0 +1,146 @@
+import json
+import os
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+import logging
+
+# Durable outbox ##############################################################
+# Matched messages are appended to a JSON lines file before they are handed
+# to the Slack sender and acknowledged once chat_postMessage succeeds, so a
+# crash or restart only loses what was written in the last `sync_interval`
+# seconds. A background thread fsyncs the file in batches instead of once
+# per message and rewrites it with just the unacknowledged entries once
+# enough acks have piled up. Records are one of
+#   {"id": 7, "message": {...}}   a message waiting to be posted
+#   {"ack": 7}                    message 7 was delivered
+
+class Outbox:
+    """Append-only log of undelivered Slack messages"""
+
+    def __init__(self, file, sync_interval=0.2, compact_after=1000):
+        self.file = file
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+        # lock guards the entries and the buffered writes, sync_lock the
+        # fsync and compaction so neither blocks appends for long
+        self.lock = Lock()
+        self.sync_lock = Lock()
+        self.entries = OrderedDict()
+        self.next_id = 1
+        self.dirty = False
+        self.acks = 0
+
+        # counters
+        self.appended = 0
+        self.acked = 0
+        self.syncs = 0
+        self.compactions = 0
+
+        self._recover()
+        self._file = open(self.file, 'a')
+        self.stopping = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _recover(self):
+        """Load the entries that were never acknowledged"""
+        if not os.path.exists(self.file):
+            return
+        with open(self.file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a torn last line from a crash mid-write
+                    logging.warning("Skipping bad outbox record in %s", self.file)
+                    continue
+                if 'ack' in entry:
+                    self.entries.pop(entry['ack'], None)
+                else:
+                    self.entries[entry['id']] = entry['message']
+                    self.next_id = max(self.next_id, entry['id'] + 1)
+        if self.entries:
+            logging.info("Outbox has %d unsent messages", len(self.entries))
+        self._compact()
+
+    def append(self, message):
+        """Record a message to be posted and return its id"""
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = message
+            self._file.write(json.dumps({'id': entry_id, 'message': message}) + '\n')
+            self.dirty = True
+            self.appended += 1
+        return entry_id
+
+    def ack(self, entry_id):
+        """Mark a message as delivered"""
+        with self.lock:
+            # acks after close() are lost and the message is sent again
+            if self._file.closed or self.entries.pop(entry_id, None) is None:
+                return
+            self._file.write('{"ack": %d}\n' % entry_id)
+            self.dirty = True
+            self.acks += 1
+            self.acked += 1
+
+    def pending(self):
+        """Return [(id, message), ...] for everything not yet acknowledged"""
+        with self.lock:
+            return list(self.entries.items())
+
+    def sync(self):
+        """Flush buffered records and fsync them"""
+        with self.sync_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                self._file.flush()
+                self.dirty = False
+            os.fsync(self._file.fileno())
+            self.syncs += 1
+
+    def _run(self):
+        while not self.stopping.wait(self.sync_interval):
+            try:
+                self.sync()
+                # only worth rewriting once most of the file is acked entries
+                if self.acks >= self.compact_after and self.acks > len(self.entries):
+                    self.compact()
+            except OSError as e:
+                logging.error("Could not write outbox %s: %s", self.file, e)
+
+    def compact(self):
+        """Rewrite the file with only the unacknowledged entries"""
+        with self.sync_lock, self.lock:
+            self._file.close()
+            self._compact()
+            self._file = open(self.file, 'a')
+
+    def _compact(self):
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w') as f:
+            for entry_id, message in self.entries.items():
+                f.write(json.dumps({'id': entry_id, 'message': message}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.file)
+        self.dirty = False
+        self.acks = 0
+        self.compactions += 1
+
+    def stats(self):
+        return {'pending': len(self.entries),
+                'appended': self.appended,
+                'acked': self.acked,
+                'syncs': self.syncs,
+                'compactions': self.compactions}
+
+    def close(self):
+        """Stop the sync thread and leave a compacted file behind"""
+        self.stopping.set()
+        self.thread.join()
+        self.compact()
+        with self.lock:
+            self._file.close()
@@ -0,0 +1,426 @@
+import json
+import os
+import re
+import logging
+from threading import Lock
+
+import yaml
+
+try:
+    config = yaml.safe_load(open('config.yaml'))
+except yaml.YAMLError as exc:
+    print(exc)
+
+# Keyword query language ######################################################
+# Each keywords.csv entry (or route keyword) is either a plain keyword or a
+# query. Plain keywords match as a phrase: "machine learning" matches
+# "Machine-learning" but not "machine ... learning". An entry containing
+# quotes, parentheses, AND/OR/NOT or a leading - is parsed as a query:
+#
+#   Google OR Alphabet              either term
+#   TPU AND Google                  both terms
+#   "deep learning" -hiring         a phrase, and not the word hiring
+#   #AI OR $GOOG                    a hashtag or a cashtag
+#   (OpenAI OR Anthropic) NOT =AI   =Term matches the case exactly
+#
+# Inside a query, terms next to each other are ANDed: (TPU Google) OR Gemini.
+# Matching is case-insensitive unless a term starts with =. Text is split
+# into words of letters, digits and inner apostrophes, and a trailing 's is
+# dropped, so IBM matches "IBM's", "#IBM" and "ibm,". A word can end in +
+# or #, so C++ and C# are words of their own and don't match C.
+#
+# Every entry compiles to a plan of nodes. Each node carries `p`, an
+# estimate of the share of texts it is true for, and `anchors`, words of
+# which at least one must be in a text for the node to match, so the
+# matcher only evaluates plans that could succeed. p comes from document
+# frequencies counted over real tweets (see TermStats): AND children are
+# tried least likely first and OR children most likely first. Without
+# counts every word has the same p and children keep the written order.
+
+TAGS = '#$@'
+OPERATORS = ('AND', 'OR', 'NOT')
+
+TOKEN_RE = re.compile(r"[#$@]?\w+(?:['\u2019]\w+)*(?:[+#]+$)?")
+_POSSESSIVE = ("'s", "'S", "\u2019s", "\u2019S")
+
+class QueryError(ValueError):
+    pass
+
+# punctuation trimmed from either end of a token before anything slower,
+# not + which ends words like C++
+_EDGES = '!"%&()*,-./:;<=>?[\\]^_`{|}~\'\u2018\u2019\u201c\u201d\u2026'
+
+def tokenize(text):
+    """Split text into (words, tags), tags keep their #, $ or @"""
+    return split_tokens(text.split())
+
+def split_tokens(tokens):
+    """tokenize for text that has already been split on whitespace"""
+    words = []
+    tags = []
+    for token in tokens:
+        # most tokens are plain words
+        if token.isalnum():
+            words.append(token)
+            continue
+        if '://' in token:
+            # links are t.co redirects, nothing worth matching
+            continue
+        token = token.strip(_EDGES)
+        mark = token[:1]
+        if mark in TAGS:
+            token = token[1:]
+        else:
+            mark = None
+        if token.endswith(_POSSESSIVE):
+            token = token[:-2]
+        if token.isalnum():
+            pieces = (token,)
+        elif token:
+            # inner punctuation: hyphenated words, contractions
+            pieces = TOKEN_RE.findall(token)
+        else:
+            continue
+        for word in pieces:
+            words.append(word)
+        if mark and len(pieces) == 1:
+            tags.append(mark + token)
+    return words, tags
+
+class TokenStream:
+    """One text split into words once, shared by every plan"""
+    __slots__ = ('text', 'lowered', 'keys', 'tags', '_folded', '_words', '_exact')
+
+    def __init__(self, text):
+        self.text = text
+        self.lowered = text.casefold()
+        tokens = self.lowered.split()
+        # every plain token is already a word, so the set of words is the
+        # tokens plus whatever the few others split into. Leftover raw
+        # tokens like "ibm's" never equal a compiled term so they are harmless
+        keys = set(tokens)
+        others = [t for t in tokens if not t.isalnum()]
+        if others:
+            words, tags = split_tokens(others)
+            keys.update(words)
+            keys.update(tags)
+            self.tags = frozenset(tags)
+        else:
+            self.tags = frozenset()
+        # everything a plan can be anchored on
+        self.keys = keys
+        self._folded = None
+        self._words = None
+        self._exact = None
+
+    # the word sequences are only needed by phrases and =terms
+
+    @property
+    def folded(self):
+        if self._folded is None:
+            self._folded = tokenize(self.lowered)[0]
+        return self._folded
+
+    @property
+    def words(self):
+        if self._words is None:
+            self._words = tokenize(self.text)[0]
+        return self._words
+
+    @property
+    def exact(self):
+        if self._exact is None:
+            self._exact = set(self.words)
+        return self._exact
+
+def split_term(text):
+    """(tag mark or '', words) for a term, split the same way as tweets"""
+    words, tags = tokenize(text)
+    if not words:
+        raise QueryError("No words in {!r}".format(text))
+    mark = tags[0][0] if len(words) == 1 and tags else ''
+    return mark, words
+
+# Term statistics #############################################################
+# Document frequencies: how many texts each word, hashtag and cashtag
+# appeared in. `python replay.py tweets.jsonl --term-stats` counts them
+# over recorded tweets into term_stats_file, which every matcher reads.
+
+# p of every term when nothing has been counted
+DEFAULT_P = 0.05
+
+class TermStats:
+    """How many of `docs` texts contained each key (casefolded word or tag)"""
+
+    def __init__(self, docs=0, counts=None):
+        self.docs = docs
+        self.counts = counts or {}
+
+    def add(self, text):
+        words, tags = tokenize(text.casefold())
+        self.docs += 1
+        counts = self.counts
+        for key in set(words).union(tags):
+            counts[key] = counts.get(key, 0) + 1
+
+    def p(self, key):
+        """Share of texts containing key, smoothed so unseen keys aren't 0"""
+        if not self.docs:
+            return DEFAULT_P
+        return (self.counts.get(key, 0) + 0.5) / (self.docs + 1)
+
+    @classmethod
+    def load(cls, file):
+        try:
+            with open(file, 'r') as f:
+                data = json.load(f)
+            return cls(data['docs'], data['counts'])
+        except (OSError, ValueError, KeyError) as e:
+            logging.error("Could not read term stats %s: %s", file, e)
+            return cls()
+
+    def save(self, file):
+        # keys seen once are left out, p() treats them like unseen ones
+        counts = {key: n for key, n in self.counts.items() if n > 1}
+        tmp = file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'docs': self.docs, 'counts': counts}, f)
+        os.replace(tmp, file)
+
+_stats = None
+_stats_lock = Lock()
+
+def get_term_stats():
+    """The counts in term_stats_file, read once, empty if there is none"""
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            file = config.get('term_stats_file')
+            if file and os.path.exists(file):
+                _stats = TermStats.load(file)
+            else:
+                _stats = TermStats()
+    return _stats
+
+_NO_STATS = TermStats()
+
+# Plan nodes ##################################################################
+
+class Word:
+    __slots__ = ('word', 'key', 'exact', 'p', 'anchors')
+
+    def __init__(self, word, exact=False, stats=None):
+        self.word = word
+        self.key = word.casefold()
+        self.exact = exact
+        self.p = (stats or _NO_STATS).p(self.key)
+        self.anchors = frozenset((self.key,))
+
+    def evaluate(self, s):
+        return self.word in s.exact if self.exact else self.key in s.keys
+
+class Tag:
+    __slots__ = ('key', 'p', 'anchors')
+
+    def __init__(self, prefix, word, stats=None):
+        self.key = prefix + word.casefold()
+        self.p = (stats or _NO_STATS).p(self.key)
+        self.anchors = frozenset((self.key,))
+
+    def evaluate(self, s):
+        return self.key in s.tags
+
+class Phrase:
+    __slots__ = ('words', 'exact', 'p', 'anchors')
+
+    def __init__(self, words, exact=False, stats=None):
+        self.words = words if exact else [w.casefold() for w in words]
+        self.exact = exact
+        stats = stats or _NO_STATS
+        # no more likely than its rarest word, which anchors it (the
+        # longest of the rarest, when nothing has been counted)
+        rarest = min((w.casefold() for w in words),
+                     key=lambda key: (stats.p(key), -len(key)))
+        self.p = stats.p(rarest)
+        self.anchors = frozenset((rarest,))
+
+    def evaluate(self, s):
+        seq = s.words if self.exact else s.folded
+        present = s.exact if self.exact else s.keys
+        words = self.words
+        for w in words:
+            if w not in present:
+                return False
+        n = len(words)
+        first = words[0]
+        for i in range(len(seq) - n + 1):
+            if seq[i] == first and seq[i:i + n] == words:
+                return True
+        return False
+
+class And:
+    __slots__ = ('children', 'p', 'anchors')
+
+    def __init__(self, children):
+        # cheapest to fail first
+        self.children = sorted(children, key=lambda c: c.p)
+        # as if the children were independent
+        self.p = 1.0
+        for c in children:
+            self.p *= c.p
+        anchored = [c.anchors for c in children if c.anchors is not None]
+        self.anchors = min(anchored, key=len) if anchored else None
+
+    def evaluate(self, s):
+        for c in self.children:
+            if not c.evaluate(s):
+                return False
+        return True
+
+class Or:
+    __slots__ = ('children', 'p', 'anchors')
+
+    def __init__(self, children):
+        # most likely to succeed first
+        self.children = sorted(children, key=lambda c: -c.p)
+        miss = 1.0
+        for c in children:
+            miss *= 1 - c.p
+        self.p = 1 - miss
+        if any(c.anchors is None for c in children):
+            self.anchors = None
+        else:
+            self.anchors = frozenset().union(*(c.anchors for c in children))
+
+    def evaluate(self, s):
+        for c in self.children:
+            if c.evaluate(s):
+                return True
+        return False
+
+class Not:
+    __slots__ = ('child', 'p', 'anchors')
+
+    def __init__(self, child):
+        self.child = child
+        self.p = 1 - child.p
+        # matches texts without the child's words, so can't be anchored
+        self.anchors = None
+
+    def evaluate(self, s):
+        return not self.child.evaluate(s)
+
+# Parsing #####################################################################
+
+def is_query(entry):
+    """True if entry uses query syntax rather than being a plain keyword"""
+    if any(c in entry for c in '"()'):
+        return True
+    return any(t in OPERATORS or t[0] in '-=' for t in entry.split())
+
+def term(text, exact=False, stats=None):
+    """Compile a single term or phrase"""
+    prefix, ws = split_term(text)
+    if prefix:
+        return Tag(prefix, ws[0], stats)
+    if len(ws) == 1:
+        return Word(ws[0], exact, stats)
+    return Phrase(ws, exact, stats)
+
+def lex(entry):
+    """Split a query into (kind, text) tokens"""
+    tokens = []
+    i = 0
+    n = len(entry)
+    while i < n:
+        c = entry[i]
+        if c.isspace():
+            i += 1
+        elif c in '()':
+            tokens.append((c, c))
+            i += 1
+        elif c == '"':
+            end = entry.find('"', i + 1)
+            if end < 0:
+                raise QueryError("Unterminated quote in {!r}".format(entry))
+            tokens.append(('TERM', entry[i + 1:end]))
+            i = end + 1
+        elif c in '-=' and i + 1 < n and not entry[i + 1].isspace():
+            tokens.append(('NOT' if c == '-' else 'EXACT', c))
+            i += 1
+        else:
+            start = i
+            while i < n and not entry[i].isspace() and entry[i] not in '()"':
+                i += 1
+            text = entry[start:i]
+            tokens.append((text if text in OPERATORS else 'TERM', text))
+    return tokens
+
+class _Parser:
+    def __init__(self, entry, stats=None):
+        self.entry = entry
+        self.stats = stats
+        self.tokens = lex(entry)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise QueryError("Unexpected {!r} in {!r}".format(
+                self.tokens[self.pos][1], self.entry))
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.next()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and(self):
+        children = [self.parse_unary()]
+        while self.peek() not in (None, ')', 'OR'):
+            if self.peek() == 'AND':
+                self.next()
+            children.append(self.parse_unary())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_unary(self):
+        kind = self.peek()
+        if kind == 'NOT':
+            self.next()
+            return Not(self.parse_unary())
+        if kind == '(':
+            self.next()
+            node = self.parse_or()
+            if self.peek() != ')':
+                raise QueryError("Missing ) in {!r}".format(self.entry))
+            self.next()
+            return node
+        exact = kind == 'EXACT'
+        if exact:
+            self.next()
+            kind = self.peek()
+        if kind != 'TERM':
+            raise QueryError("Expected a term in {!r}".format(self.entry))
+        return term(self.next()[1], exact, self.stats)
+
+def compile(entry, stats=None):
+    """
+    Compile a keywords.csv entry into a plan, raises QueryError.
+    stats (a TermStats) gives the terms' p
+    """
+    entry = entry.strip()
+    if not entry:
+        raise QueryError("Empty keyword")
+    if is_query(entry):
+        return _Parser(entry, stats).parse()
+    return term(entry, stats=stats)
@@ -0,0 +1,99 @@
+import random
+from collections import deque
+
+# Rate limiting helpers #######################################################
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second up to `burst` tokens.
+    Time is passed in by the caller so it works with any clock.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = None
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """
+        Consume a token and return 0, or return the number of seconds
+        to wait before a token will be available
+        """
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, now, seconds):
+        """Hand out no tokens for `seconds`, e.g. after a Retry-After"""
+        self.paused_until = max(self.paused_until, now + seconds)
+        # don't let a burst pile up behind the pause
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+class WindowLimit:
+    """
+    At most `limit` calls in any `window` seconds, like Twitter's 15 minute
+    rate limit windows. Time is passed in by the caller
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = float(window)
+        self.calls = deque()
+
+    def wait(self, now):
+        """Seconds until another call is allowed, 0 if it is now"""
+        calls = self.calls
+        while calls and now - calls[0] >= self.window:
+            calls.popleft()
+        if len(calls) < self.limit:
+            return 0
+        return calls[0] + self.window - now
+
+    def record(self, now):
+        self.calls.append(now)
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with full jitter for the given retry attempt"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+# Stream reconnects, as Twitter recommends:
+# https://developer.twitter.com/en/docs/twitter-api/v1/tweets/filter-realtime/guides/connecting
+#   network   TCP/IP errors and timeouts, linear from 250ms up to 16s
+#   http      HTTP errors, exponential from 5s up to 320s
+#   rate_limit  420/429, exponential from 60s
+#   closed    Twitter closed a healthy stream, reconnect at once, then linearly
+RECONNECT_CURVES = {
+    # kind: (first delay, step, exponential, cap)
+    'network': (0.25, 0.25, False, 16.0),
+    'http': (5.0, 2.0, True, 320.0),
+    'rate_limit': (60.0, 2.0, True, 960.0),
+    'closed': (0.0, 0.25, False, 16.0),
+}
+
+def reconnect_delay(kind, attempt, jitter=0.2):
+    """
+    Seconds to wait before reconnecting after `attempt` (0 based) failures
+    of the given kind in a row. The jitter only ever adds to the delay
+    so reconnects never come sooner than Twitter asks
+    """
+    first, step, exponential, cap = RECONNECT_CURVES[kind]
+    if exponential:
+        # the cap is reached long before the exponent could overflow
+        delay = first * step ** min(attempt, 32)
+    else:
+        delay = first + step * attempt
+    delay = min(cap, delay)
+    return delay * random.uniform(1, 1 + jitter)
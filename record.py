@@ -0,0 +1,96 @@
+# Compact tweet records #######################################################
+# Only the fields the filters and slack.build_message use are kept, so a
+# queued tweet costs a few small objects instead of a full tweepy Status
+# graph with raw JSON, entities and nested statuses.
+
+def full_text(data):
+    """Full text of a tweet payload, whichever field it arrived in"""
+    if 'extended_tweet' in data:
+        return data['extended_tweet']['full_text']
+    return data.get('full_text') or data.get('text') or ''
+
+def _media_url(data):
+    """URL of the first attached media, or None"""
+    for entities in (data.get('entities'),
+                     data.get('extended_tweet', {}).get('entities')):
+        if entities and entities.get('media'):
+            return entities['media'][0]['media_url']
+    return None
+
+class TweetRecord:
+    """The parts of a tweet the bot needs, built once at ingest"""
+    __slots__ = ('id', 'user_id', 'screen_name', 'user_icon', 'text',
+                 'display', 'media_url', 'reply_to', 'kind', 'inner', 'texts')
+
+    def __init__(self, id, user_id, screen_name, user_icon, text,
+                 media_url=None, reply_to=None, kind='tweet', inner=None,
+                 texts=None, display=None):
+        self.id = id
+        self.user_id = user_id
+        self.screen_name = screen_name
+        self.user_icon = user_icon
+        self.text = text
+        # text shown in Slack, without the trailing t.co links
+        self.display = display if display is not None else text.split('https://')[0]
+        self.media_url = media_url
+        self.reply_to = reply_to
+        # 'tweet', 'quote' or 'retweet', inner is the quoted/retweeted record
+        self.kind = kind
+        self.inner = inner
+        # every text the keyword filter searches
+        self.texts = texts if texts is not None else (text,)
+
+    @classmethod
+    def from_dict(cls, data, nested=True):
+        """Build a record from a decoded Twitter API payload"""
+        user = data['user']
+        text = full_text(data)
+        kind, inner, texts = 'tweet', None, (text,)
+        if nested:
+            quoted = data.get('quoted_status')
+            retweeted = data.get('retweeted_status')
+            # quotes win over retweets, matching build_message's branches
+            if quoted:
+                kind, inner = 'quote', cls.from_dict(quoted, nested=False)
+            elif retweeted:
+                kind, inner = 'retweet', cls.from_dict(retweeted, nested=False)
+            if quoted and retweeted:
+                texts = (text, inner.text, full_text(retweeted))
+            elif inner is not None:
+                texts = (text, inner.text)
+        return cls(data.get('id_str') or str(data['id']),
+                   user.get('id_str') or str(user['id']),
+                   user['screen_name'],
+                   user.get('profile_image_url'),
+                   text,
+                   _media_url(data),
+                   data.get('in_reply_to_status_id'),
+                   kind, inner, texts)
+
+    @classmethod
+    def from_status(cls, status):
+        """Build a record from a tweepy Status"""
+        return cls.from_dict(status._json)
+
+    @property
+    def canonical_id(self):
+        """The id of the tweet being shared, the original for retweets"""
+        if self.kind == 'retweet':
+            return self.inner.id
+        return self.id
+
+    def to_json(self):
+        """Plain dict for spilling to disk, see from_json"""
+        data = {slot: getattr(self, slot) for slot in self.__slots__}
+        data['texts'] = list(self.texts)
+        if self.inner is not None:
+            data['inner'] = self.inner.to_json()
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        data = dict(data)
+        if data.get('inner') is not None:
+            data['inner'] = cls.from_json(data['inner'])
+        data['texts'] = tuple(data['texts'])
+        return cls(**data)
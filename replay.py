@@ -0,0 +1,776 @@
+"""
+Offline replay harness and throughput benchmark.
+
+Feeds recorded tweets (one Twitter API JSON object per line) through
+MyStreamListener's on_data and process_status and into a stub Slack
+sink, then reports throughput, per-stage latency percentiles and peak
+memory. No Twitter or Slack credentials are needed.
+
+    python replay.py tweets.jsonl             # as fast as possible
+    python replay.py tweets.jsonl --rate 500  # 500 tweets/s
+    python replay.py --synthetic 20000        # generated tweets
+    python replay.py --synthetic 20000 --outbox  # outbox write throughput
+    python replay.py --synthetic 20000 --processes 1,2,4  # filter processes
+    python replay.py --reconnects 50          # stream recovery time
+    python replay.py --shards 8 --follows 36000  # follow list sharding
+    python replay.py --backfill 300           # gap backfill, stubbed API
+    python replay.py tweets.jsonl --term-stats  # count words for query.py
+"""
+import argparse
+import json
+import random
+import re
+import resource
+import sys
+import time
+import tracemalloc
+import logging
+import os
+import tempfile
+
+import tweepy
+
+import db as db
+import matcher as matcher
+import query as query
+import routing as routing
+import dedup as dedup
+import ingest as ingest
+import slack as slack
+import outbox as outbox
+import filterpool as filterpool
+import ratelimit as ratelimit
+import supervisor as supervisor
+import backfill as backfill
+import record as record
+import twitter as twitter
+
+# Stub sink ###################################################################
+
+class StubSender:
+    """Stands in for slack.SlackSender and just counts messages"""
+
+    def __init__(self, keep=False):
+        self.posted = 0
+        # the (channel, blocks) submitted, in order, with keep
+        self.messages = [] if keep else None
+
+    def submit(self, blocks=[], user_icon="", attachments=[], channel='bot-dev'):
+        self.posted += 1
+        if self.messages is not None:
+            self.messages.append((channel, blocks))
+
+    def close(self, timeout=None):
+        pass
+
+# Tweet sources ###############################################################
+
+def load_tweets(path):
+    """Read one tweet JSON object per line, skipping blank lines"""
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _user(i, screen_name):
+    return {'id': i, 'id_str': str(i), 'screen_name': screen_name,
+            'name': screen_name,
+            'profile_image_url': 'http://pbs.twimg.com/profile_images/{}.jpg'.format(i)}
+
+def synthetic_tweets(n, users=None, keywords=None, seed=0):
+    """
+    Generate n tweets shaped like the follow stream delivers them: mostly
+    replies and retweets of our accounts by other users, plus original
+    tweets, quotes and retweets by the followed accounts.
+    """
+    rng = random.Random(seed)
+    users = [u.lstrip('@') for u in (users or db.get_users())]
+    keywords = list(keywords or db.get_keywords())
+    words = ('the new model results paper today launch team cloud data '
+             'research open source release update').split()
+    tweets = []
+    for i in range(n):
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(8, 30)))
+        if rng.random() < 0.3:
+            text += ' ' + rng.choice(keywords)
+        text += ' https://t.co/abc{}'.format(i)
+        kind = rng.random()
+        if kind < 0.6:
+            # someone else replying to or retweeting a followed account
+            author = _user(10 ** 6 + rng.randint(0, 10 ** 5), 'someone{}'.format(i))
+        else:
+            j = rng.randrange(len(users))
+            author = _user(1000 + j, users[j])
+        tweet = {'id': 10 ** 12 + i, 'id_str': str(10 ** 12 + i),
+                 'created_at': 'Wed Oct 10 20:19:24 +0000 2018',
+                 'text': text[:140], 'user': author, 'truncated': len(text) > 140,
+                 'in_reply_to_status_id': None, 'entities': {}}
+        if len(text) > 140:
+            tweet['extended_tweet'] = {'full_text': text, 'entities': {}}
+        if rng.random() < 0.1:
+            tweet['entities']['media'] = [{'media_url': 'http://pbs.twimg.com/media/{}.jpg'.format(i)}]
+        if kind < 0.3:
+            tweet['in_reply_to_status_id'] = 10 ** 12 + rng.randint(0, n)
+        elif kind < 0.6 or kind > 0.9:
+            original = dict(tweet, id=10 ** 11 + i, id_str=str(10 ** 11 + i),
+                            user=_user(1000, users[0]), entities={})
+            original.pop('extended_tweet', None)
+            tweet['text'] = 'RT @{}: {}'.format(users[0], text)[:140]
+            tweet['retweeted_status'] = original
+        elif kind > 0.85:
+            quoted = dict(tweet, id=10 ** 11 + i, id_str=str(10 ** 11 + i),
+                          user=_user(1001, 'quoted'), entities={})
+            quoted.pop('extended_tweet', None)
+            tweet['quoted_status'] = quoted
+        tweets.append(tweet)
+    return tweets
+
+# Pipeline ####################################################################
+# Tweets go through a real MyStreamListener: on_data decodes, filters and
+# queues them, then process_status routes, dedups, renders and hands them
+# to the stub sender. The worker pool is stopped so each tweet is taken off
+# the queue and processed here, in this thread, where it can be timed.
+
+STAGES = ('ingest', 'process')
+# the listener's own stage histograms, reported as means
+LISTENER_STAGES = ('filter', 'preprocess', 'route', 'render')
+
+def replay_listener(sender, tweets, channel='bot-dev'):
+    """
+    A MyStreamListener following the authors of tweets that are in the
+    user list, without worker threads or persistent state
+    """
+    listener = twitter.MyStreamListener(channel=channel, sender=sender)
+    listener.pool.stop()
+    listener.pool.join()
+    if listener.filters is not None:
+        # --processes benchmarks the filter processes
+        listener.filters.stop()
+        listener.filters = None
+        listener.reload_rules()
+    listener.dedup = dedup.DedupCache()
+    listener.checkpoints = backfill.Checkpoints()
+    users = db.user_set()
+    listener.follow_ids = frozenset(t['user']['id_str'] for t in tweets
+                                    if '@' + t['user']['screen_name'] in users)
+    return listener
+
+def process(raw, listener, timings):
+    """Run one raw payload through the listener, timing both halves"""
+    clock = time.perf_counter
+    t0 = clock()
+    listener.on_data(raw)
+    t1 = clock()
+    timings['ingest'].append(t1 - t0)
+    tweet = listener.q.get(block=False)
+    if tweet is None:
+        # rejected by on_data
+        return
+    listener.process_status(tweet)
+    timings['process'].append(clock() - t1)
+
+def _stage_totals():
+    """(count, sum) of each listener stage histogram so far"""
+    totals = {}
+    for stage in LISTENER_STAGES:
+        child = twitter.STAGE.labels(stage)
+        with child.lock:
+            totals[stage] = (sum(child.counts), child.sum)
+    return totals
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def replay(tweets, rate=0, trace_memory=False):
+    """Replay tweets at `rate` tweets/s (0 = as fast as possible)"""
+    sender = StubSender()
+    listener = replay_listener(sender, tweets)
+    payloads = [json.dumps(t).encode('utf-8') for t in tweets]
+    timings = {stage: [] for stage in STAGES}
+    before = _stage_totals()
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    for i, raw in enumerate(payloads):
+        if rate:
+            # pace against the schedule rather than sleeping a fixed amount
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        process(raw, listener, timings)
+    elapsed = time.perf_counter() - start
+    after = _stage_totals()
+
+    report = {'tweets': len(tweets),
+              'posted': sender.posted,
+              'seconds': elapsed,
+              'tweets_per_second': len(tweets) / elapsed if elapsed else 0.0,
+              'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              'stages': {}}
+    if trace_memory:
+        report['traced_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    for stage, values in timings.items():
+        report['stages'][stage] = {
+            'count': len(values),
+            'p50_us': percentile(values, 50) * 1e6,
+            'p90_us': percentile(values, 90) * 1e6,
+            'p99_us': percentile(values, 99) * 1e6,
+            'max_us': max(values) * 1e6 if values else 0.0}
+    report['listener_stages'] = {}
+    for stage in LISTENER_STAGES:
+        count = after[stage][0] - before[stage][0]
+        total = after[stage][1] - before[stage][1]
+        report['listener_stages'][stage] = {
+            'count': count, 'mean_us': total / count * 1e6 if count else 0.0}
+    return report
+
+# Ingest benchmark ############################################################
+
+def _filter_by_user(screen_name):
+    """The old per-tweet author check, the baseline for bench_ingest"""
+    return '@' + str(screen_name) in db.user_set()
+
+def _filter_by_word(tweet, keyword_matcher):
+    """The old keyword check on a built record, the baseline for bench_ingest"""
+    return keyword_matcher.match_any(tweet.texts)
+
+def bench_ingest(tweets):
+    """
+    Compare decoding every payload into a tweepy Status (the default
+    StreamListener.on_data path) with the early rejection fast path
+    """
+    users = db.user_set()
+    keyword_matcher = matcher.get_matcher(db.keyword_set())
+    follow_ids = frozenset(t['user']['id_str'] for t in tweets
+                           if '@' + t['user']['screen_name'] in users)
+    payloads = [json.dumps(t).encode('utf-8') for t in tweets]
+
+    start = time.perf_counter()
+    kept_full = 0
+    for raw in payloads:
+        tweet = twitter.preprocess_text(tweepy.Status.parse(None, json.loads(raw)))
+        if _filter_by_user(tweet.screen_name) and \
+                tweet.reply_to is None and \
+                _filter_by_word(tweet, keyword_matcher):
+            kept_full += 1
+    full = time.perf_counter() - start
+
+    start = time.perf_counter()
+    kept_fast = 0
+    for raw in payloads:
+        data = ingest.loads(raw)
+        if ingest.reject_reason(data, follow_ids, keyword_matcher) is None:
+            twitter.preprocess_text(data)
+            kept_fast += 1
+    fast = time.perf_counter() - start
+
+    return {'tweets': len(payloads),
+            'full_kept': kept_full, 'full_per_second': len(payloads) / full,
+            'fast_kept': kept_fast, 'fast_per_second': len(payloads) / fast,
+            'decoder': ingest.loads.__module__,
+            'speedup': full / fast}
+
+# Render benchmark ############################################################
+
+def bench_render(tweets, rounds=5):
+    """Time and allocations per slack.build_message call"""
+    records = [twitter.preprocess_text(t) for t in tweets]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for tweet in records:
+            slack.build_message(tweet)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    kept = [slack.build_message(tweet) for tweet in records]
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return {'messages': len(records),
+            'us_per_message': elapsed / (rounds * len(records)) * 1e6,
+            'bytes_per_message': size / len(records)}
+
+# Queue memory benchmark ######################################################
+
+def _traced_size(build, tweets):
+    """Bytes allocated by build() for every tweet, while all are kept alive"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(t) for t in tweets]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return size
+
+def bench_queue_memory(tweets):
+    """Memory per queued tweet: full tweepy Status vs TweetRecord"""
+    # decode a fresh copy each time so both sides pay for their own strings
+    status_bytes = _traced_size(
+        lambda t: tweepy.Status.parse(None, json.loads(json.dumps(t))), tweets)
+    record_bytes = _traced_size(
+        lambda t: twitter.preprocess_text(json.loads(json.dumps(t))), tweets)
+    return {'tweets': len(tweets),
+            'status_bytes_per_tweet': status_bytes / len(tweets),
+            'record_bytes_per_tweet': record_bytes / len(tweets),
+            'reduction': status_bytes / record_bytes}
+
+# Outbox benchmark ############################################################
+
+def bench_outbox(tweets, sync_interval=0.2, unbatched=2000):
+    """
+    Outbox write throughput with batched fsyncs, compared with an
+    fsync after every message for the first `unbatched` messages
+    """
+    messages = [{'blocks': slack.build_message(twitter.preprocess_text(t)),
+                 'user_icon': t['user'].get('profile_image_url'),
+                 'attachments': [], 'channel': 'bot-dev'}
+                for t in tweets]
+    with tempfile.TemporaryDirectory() as tmp:
+        box = outbox.Outbox(os.path.join(tmp, 'outbox.jsonl'),
+                            sync_interval=sync_interval,
+                            compact_after=len(messages) + 1)
+        start = time.perf_counter()
+        ids = [box.append(m) for m in messages]
+        box.sync()
+        append = time.perf_counter() - start
+        size = os.path.getsize(box.file)
+
+        start = time.perf_counter()
+        for entry_id in ids:
+            box.ack(entry_id)
+        box.sync()
+        ack = time.perf_counter() - start
+
+        start = time.perf_counter()
+        box.compact()
+        compact = time.perf_counter() - start
+        box.close()
+
+        single = outbox.Outbox(os.path.join(tmp, 'single.jsonl'),
+                               sync_interval=3600)
+        sample = messages[:unbatched]
+        start = time.perf_counter()
+        for m in sample:
+            single.append(m)
+            single.sync()
+        unbatched_time = time.perf_counter() - start
+        single.close()
+
+    return {'messages': len(messages),
+            'bytes_per_message': size / len(messages),
+            'append_per_second': len(messages) / append,
+            'ack_per_second': len(messages) / ack,
+            'compact_ms': compact * 1e3,
+            'unbatched_per_second': len(sample) / unbatched_time,
+            'speedup': (len(messages) / append) / (len(sample) / unbatched_time)}
+
+# Multiprocess filtering benchmark ############################################
+
+def _filter_in_process(payloads, router):
+    """What one filter process does with its payloads, in this process"""
+    keyword_matcher = None if router.any_keyword else router.matcher
+    matched = 0
+    for raw in payloads:
+        data = ingest.loads(raw)
+        if ingest.content_reject_reason(data, keyword_matcher) is not None:
+            continue
+        tweet = record.TweetRecord.from_dict(data)
+        if router.route(tweet):
+            slack.build_message(tweet)
+            matched += 1
+    return matched
+
+def bench_filter_processes(tweets, counts=(1, 2, 4)):
+    """
+    Filter throughput for the followed accounts' tweets in this process
+    and with each number of filter processes in `counts`
+    """
+    router = routing.get_router()
+    follow = {ingest.author_id(t) for t in tweets
+              if '@' + t['user']['screen_name'] in router.users}
+    payloads = [(json.dumps(t), ingest.author_id(t)) for t in tweets
+                if ingest.author_id(t) in follow]
+
+    start = time.perf_counter()
+    matched = _filter_in_process([raw for raw, _ in payloads], router)
+    elapsed = time.perf_counter() - start
+    report = {'payloads': len(payloads), 'matched': matched, 'cpus': os.cpu_count(),
+              'in_process_per_second': len(payloads) / elapsed, 'processes': {}}
+
+    for n in counts:
+        pool = filterpool.FilterPool(lambda *match: None, processes=n).start()
+        start = time.perf_counter()
+        for raw, author in payloads:
+            pool.submit(raw, author)
+        # stop() returns once every submitted payload has been handled
+        pool.stop(timeout=600)
+        elapsed = time.perf_counter() - start
+        report['processes'][n] = {'per_second': len(payloads) / elapsed,
+                                  'matched': pool.matched,
+                                  'speedup': len(payloads) / elapsed
+                                             / report['in_process_per_second']}
+    if (os.cpu_count() or 1) < 2:
+        report['note'] = 'single CPU, the processes can only be slower than in-process'
+    return report
+
+# Reconnect benchmark #########################################################
+
+class FlakyStream:
+    """
+    Stands in for a tweepy Stream. Each connection takes the next outcome
+    from `script`: 'closed' (connects, then Twitter closes it after `hold`
+    seconds), 'timeout', 'reset' (connection reset) or 'http' (a 503),
+    and stays connected once the script runs out
+    """
+
+    def __init__(self, listener, script, hold, failed_at):
+        self.listener = listener
+        self.script = script
+        self.hold = hold
+        self.failed_at = failed_at
+        self.running = False
+
+    def filter(self, follow=None, stall_warnings=False):
+        self.running = True
+        outcome = self.script.pop(0) if self.script else None
+        if outcome == 'http':
+            self.failed_at.append(time.monotonic())
+            self.listener.on_error(503)
+            return
+        if outcome == 'timeout':
+            self.failed_at.append(time.monotonic())
+            self.listener.on_timeout()
+            return
+        if outcome == 'reset':
+            self.failed_at.append(time.monotonic())
+            error = ConnectionResetError(104, 'Connection reset by peer')
+            self.listener.on_exception(error)
+            raise error
+        self.listener.on_connect()
+        if outcome == 'closed':
+            time.sleep(self.hold)
+            self.failed_at.append(time.monotonic())
+            return
+        while self.running:
+            time.sleep(0.01)
+
+    def disconnect(self):
+        self.running = False
+
+def bench_reconnects(disconnects=50, hold=0.05, seed=0):
+    """
+    Time from losing the stream to being connected again, for a mix of
+    closed streams, timeouts and connection resets, through the supervisor
+    """
+    rng = random.Random(seed)
+    script = [rng.choice(('closed', 'closed', 'timeout', 'reset'))
+              for _ in range(disconnects)]
+    kinds = {k: script.count(k) for k in set(script)}
+    failed_at = []
+    recovered = []
+    # failures already counted in a recovery, measured from the first in a row
+    counted = [0]
+
+    class Listener:
+        def on_data(self, raw_data):
+            return True
+
+    sup = supervisor.StreamSupervisor(
+        Listener(), lambda listener: FlakyStream(listener, script, hold, failed_at),
+        ids=['1'], name='bench', stable_after=hold * 2)
+    connected = sup.connected
+
+    def record(connection):
+        if len(failed_at) > counted[0]:
+            recovered.append(time.monotonic() - failed_at[counted[0]])
+            counted[0] = len(failed_at)
+        connected(connection)
+    sup.connected = record
+
+    start = time.monotonic()
+    sup.start()
+    while script or counted[0] < len(failed_at):
+        time.sleep(0.01)
+    elapsed = time.monotonic() - start
+    sup.stop()
+
+    # Twitter's curves without jitter, for comparison with the old fixed 60s
+    schedule = {kind: [round(ratelimit.reconnect_delay(kind, n, jitter=0), 2)
+                       for n in range(6)]
+                for kind in ratelimit.RECONNECT_CURVES}
+    ms = [r * 1e3 for r in recovered]
+    return {'disconnects': disconnects, 'kinds': kinds, 'seconds': elapsed,
+            'recovery_p50_ms': percentile(ms, 50),
+            'recovery_p90_ms': percentile(ms, 90),
+            'recovery_max_ms': max(ms) if ms else 0.0,
+            'stats': sup.stats(), 'schedule_seconds': schedule}
+
+# Sharding benchmark ##########################################################
+
+def bench_shards(connections, follows, follow_limit=5000, seed=0):
+    """
+    Split `follows` ids over `connections` streams of at most
+    `follow_limit` and count how many connections reconnect when one
+    account is added, and how many ids move when a connection is added
+    """
+    rng = random.Random(seed)
+    ids = [str(rng.randrange(10 ** 6, 10 ** 19)) for _ in range(follows)]
+    streams = []
+    failed_at = []
+
+    class Listener:
+        def on_data(self, raw_data):
+            return True
+
+    def new_stream(listener, shard):
+        stream = FlakyStream(listener, [], 0, failed_at)
+        streams.append(stream)
+        return stream
+
+    start = time.perf_counter()
+    manager = supervisor.StreamManager(Listener(), new_stream, ids,
+                                       connections=connections,
+                                       follow_limit=follow_limit)
+    split = time.perf_counter() - start
+    sizes = [len(shard) for shard in manager.ids]
+    manager.start()
+
+    start = time.perf_counter()
+    reconnected = manager.reconnect(ids + [str(rng.randrange(10 ** 6, 10 ** 19))])
+    reload = time.perf_counter() - start
+    manager.stop()
+
+    more = supervisor.StreamManager(Listener(), new_stream, ids,
+                                    connections=connections + 1,
+                                    follow_limit=follow_limit)
+    before = {user_id: i for i, shard in enumerate(manager.ids) for user_id in shard}
+    moved = sum(1 for i, shard in enumerate(more.ids) for user_id in shard
+                if before.get(user_id) != i)
+    return {'connections': connections, 'follows': follows,
+            'follow_limit': follow_limit,
+            'split_ms': split * 1e3, 'reload_ms': reload * 1e3,
+            'smallest_shard': min(sizes), 'largest_shard': max(sizes),
+            'reconnected_for_one_new_account': len(reconnected),
+            'moved_adding_a_connection': moved / float(follows)}
+
+# Backfill benchmark ##########################################################
+
+class _Status:
+    def __init__(self, data):
+        self._json = data
+
+# the status link slack.build_message puts in every post
+STATUS_LINK_RE = re.compile(r'/status/(\d+)')
+
+class StubTimelineAPI:
+    """
+    Stands in for tweepy.API.user_timeline: every account has `per_user`
+    tweets newer than any checkpoint, each call takes `latency` seconds
+    """
+
+    def __init__(self, timelines, latency=0.05):
+        self.timelines = timelines
+        self.latency = latency
+        self.calls = 0
+
+    def user_timeline(self, user_id=None, since_id=None, count=20, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        newer = [t for t in self.timelines.get(user_id, ()) if t['id'] > since_id]
+        # newest first, like the API
+        newer.sort(key=lambda t: t['id'], reverse=True)
+        return [_Status(t) for t in newer[:count]]
+
+def bench_backfill(accounts=300, per_user=3, latency=0.05, overlap=0.1, seed=0):
+    """
+    Backfill `accounts` followed accounts through a stubbed API into the
+    listener pipeline, with `overlap` of the tweets already seen on the stream
+    """
+    rng = random.Random(seed)
+    handles = [u.lstrip('@') for u in db.get_users()]
+    keywords = list(db.get_keywords())
+    gap_start = int(time.time() * 1000) - 60 * 1000
+    ids = [str(2000 + i) for i in range(accounts)]
+    checkpoint = (gap_start - backfill.SNOWFLAKE_EPOCH) << 22
+    timelines = {}
+    seq = 0
+    for i, user_id in enumerate(ids):
+        user = _user(int(user_id), handles[i % len(handles)])
+        timelines[user_id] = []
+        for _ in range(per_user):
+            seq += 1
+            # posted during the minute the stream was down
+            posted = gap_start + rng.randint(1, 60 * 1000)
+            status = ((posted - backfill.SNOWFLAKE_EPOCH) << 22) + seq
+            text = 'the new model results {}'.format(rng.choice(keywords))
+            timelines[user_id].append({'id': status, 'id_str': str(status),
+                                       'full_text': text, 'user': user,
+                                       'in_reply_to_status_id': None,
+                                       'entities': {}})
+
+    sender = StubSender(keep=True)
+    listener = twitter.MyStreamListener(sender=sender)
+    listener.follow_ids = frozenset(ids)
+    # keep the fake statuses out of dedup_file and checkpoint_file
+    listener.dedup = dedup.DedupCache()
+    listener.checkpoints = backfill.Checkpoints()
+    for user_id in ids:
+        listener.checkpoints.update(user_id, checkpoint)
+    every = [t for page in timelines.values() for t in page]
+    for t in rng.sample(every, int(len(every) * overlap)):
+        listener.stream_seen.seen(t['id_str'])
+
+    api = StubTimelineAPI(timelines, latency)
+    workers = twitter.config.get('backfill_workers', 8)
+    rate = twitter.config.get('backfill_rate', 0.66)
+    burst = twitter.config.get('backfill_burst', 300)
+    backfiller = backfill.Backfiller(api, listener.backfill, listener.checkpoints,
+                                     workers=workers, rate=rate, burst=burst)
+    backfiller.lost('stream-0', ids)
+    start = time.perf_counter()
+    found = backfiller.run(backfiller.gaps.pop('stream-0'))
+    elapsed = time.perf_counter() - start
+    # the backfilled tweets were processed in run(), this stops the workers
+    listener.stop(timeout=60)
+
+    # the order the tweets reached Slack in, from the status links
+    sent = [int(status) for _, blocks in sender.messages
+            for status in STATUS_LINK_RE.findall(str(blocks))]
+
+    # every call takes `latency`, `workers` at a time, past the burst one per 1/rate
+    bound = -(-accounts // workers) * latency + max(0, accounts - burst) / rate
+    return {'accounts': accounts, 'requests': api.calls, 'found': found,
+            'already_streamed': int(len(every) * overlap), 'posted': sender.posted,
+            'chronological': sent == sorted(sent),
+            'checkpoints_advanced': all(listener.checkpoints.get(u) > checkpoint
+                                        for u in ids),
+            'seconds': elapsed, 'bound_seconds': bound,
+            'workers': workers, 'rate': rate, 'burst': burst}
+
+# Term statistics #############################################################
+
+def count_terms(tweets, file):
+    """Count how many of the tweets' texts contain each word into file"""
+    stats = query.TermStats()
+    for t in tweets:
+        for text in twitter.preprocess_text(t).texts:
+            if text:
+                stats.add(text)
+    stats.save(file)
+    return {'tweets': len(tweets), 'texts': stats.docs,
+            'terms_kept': sum(1 for n in stats.counts.values() if n > 1),
+            'file': file}
+
+def print_report(report, out=sys.stdout):
+    out.write("{tweets} tweets, {posted} posted in {seconds:.2f}s "
+              "({tweets_per_second:.0f} tweets/s)\n".format(**report))
+    out.write("max RSS {} KB".format(report['max_rss_kb']))
+    if 'traced_peak_kb' in report:
+        out.write(", traced peak {} KB".format(report['traced_peak_kb']))
+    out.write("\n{:<12} {:>8} {:>10} {:>10} {:>10} {:>10}\n".format(
+        'stage', 'count', 'p50 us', 'p90 us', 'p99 us', 'max us'))
+    for stage, s in report['stages'].items():
+        out.write("{:<12} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}\n".format(
+            stage, s['count'], s['p50_us'], s['p90_us'], s['p99_us'], s['max_us']))
+    out.write("\n{:<12} {:>8} {:>10}\n".format('listener', 'count', 'mean us'))
+    for stage, s in report['listener_stages'].items():
+        out.write("{:<12} {:>8} {:>10.1f}\n".format(stage, s['count'], s['mean_us']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', nargs='?', help='tweets to replay (JSON lines)')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='generate this many tweets instead of reading a file')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='tweets per second, 0 for as fast as possible')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='replay the input this many times')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='trace Python allocations (slower)')
+    parser.add_argument('--ingest', action='store_true',
+                        help='benchmark the on_data early rejection fast path')
+    parser.add_argument('--render', action='store_true',
+                        help='benchmark slack.build_message')
+    parser.add_argument('--queue-memory', action='store_true',
+                        help='measure memory per queued tweet')
+    parser.add_argument('--outbox', action='store_true',
+                        help='benchmark durable outbox writes')
+    parser.add_argument('--processes', type=lambda s: [int(n) for n in s.split(',')],
+                        metavar='N[,N...]',
+                        help='benchmark multiprocess filtering with N processes')
+    parser.add_argument('--reconnects', type=int, default=0, metavar='N',
+                        help='benchmark recovering from N stream disconnects')
+    parser.add_argument('--shards', type=int, default=0, metavar='N',
+                        help='benchmark splitting the follow list over N connections')
+    parser.add_argument('--follows', type=int, default=36000,
+                        help='accounts followed for --shards')
+    parser.add_argument('--backfill', type=int, default=0, metavar='N',
+                        help='benchmark backfilling N accounts from a stubbed API')
+    parser.add_argument('--term-stats', action='store_true',
+                        help='count word frequencies into term_stats_file')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.backfill:
+        logging.getLogger().setLevel(logging.ERROR)
+        print(json.dumps(bench_backfill(args.backfill), indent=2))
+        return
+
+    if args.shards:
+        logging.getLogger().setLevel(logging.ERROR)
+        limit = twitter.config.get('stream_follow_limit', 5000)
+        print(json.dumps(bench_shards(args.shards, args.follows, limit), indent=2))
+        return
+
+    if args.reconnects:
+        logging.getLogger().setLevel(logging.ERROR)
+        print(json.dumps(bench_reconnects(args.reconnects), indent=2))
+        return
+
+    if args.synthetic:
+        tweets = synthetic_tweets(args.synthetic)
+    elif args.file:
+        tweets = load_tweets(args.file)
+    else:
+        parser.error('give a file to replay or --synthetic N')
+
+    # keep the per-tweet info logging out of the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.ingest:
+        report = bench_ingest(tweets * args.repeat)
+        print(json.dumps(report, indent=2))
+        return
+    if args.render:
+        report = bench_render(tweets * args.repeat)
+        print(json.dumps(report, indent=2))
+        return
+    if args.queue_memory:
+        report = bench_queue_memory(tweets * args.repeat)
+        print(json.dumps(report, indent=2))
+        return
+    if args.outbox:
+        report = bench_outbox(tweets * args.repeat)
+        print(json.dumps(report, indent=2))
+        return
+    if args.term_stats:
+        file = twitter.config.get('term_stats_file') or 'term_stats.json'
+        print(json.dumps(count_terms(tweets, file), indent=2))
+        return
+    if args.processes:
+        report = bench_filter_processes(tweets * args.repeat, args.processes)
+        print(json.dumps(report, indent=2))
+        return
+
+    report = replay(tweets * args.repeat, rate=args.rate,
+                    trace_memory=args.tracemalloc)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import yaml
+
+import db as db
+import matcher as matcher
+
+try:
+    config = yaml.safe_load(open('config.yaml'))
+except yaml.YAMLError as exc:
+    print(exc)
+
+# Multi-channel routing #######################################################
+# A rule sends tweets to a channel when the author is one of its users and
+# the text matches one of its keywords. A rule without users accepts any
+# followed author, one without keywords accepts any text. The default rule
+# is the users/keywords files posting to config['channel'].
+#
+# Rules are compiled into inverted indexes (user -> rules, keyword -> rules)
+# and one keyword matcher over every rule's keywords, so routing a tweet
+# splits its text once whatever the number of rules. Keywords can be
+# queries, see query.py.
+
+class Rule:
+    """Post tweets from `users` matching `keywords` to `channel`"""
+    __slots__ = ('channel', 'users', 'keywords')
+
+    def __init__(self, channel, users=None, keywords=None):
+        self.channel = channel.lstrip('#')
+        # None means "any"
+        self.users = None if users is None else frozenset(users)
+        self.keywords = None if keywords is None else frozenset(keywords)
+
+    @classmethod
+    def from_terms(cls, channel, terms):
+        """Build a rule from slash command terms: '@user' or keyword"""
+        users = [t for t in terms if t.startswith('@')]
+        keywords = [t for t in terms if not t.startswith('@')]
+        return cls(channel, users or None, keywords or None)
+
+class Router:
+    """Rules compiled into inverted indexes"""
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.by_user = {}
+        self.any_user = []
+        self.by_keyword = {}
+        self.any_keyword = set()
+        for i, rule in enumerate(self.rules):
+            if rule.users is None:
+                self.any_user.append(i)
+            else:
+                for user in rule.users:
+                    self.by_user.setdefault(user, []).append(i)
+            if rule.keywords is None:
+                self.any_keyword.add(i)
+            else:
+                for keyword in rule.keywords:
+                    self.by_keyword.setdefault(keyword, []).append(i)
+        self.matcher = matcher.KeywordMatcher(self.by_keyword)
+
+    @property
+    def users(self):
+        """Every user some rule follows"""
+        return frozenset(self.by_user)
+
+    def route(self, tweet):
+        """Return the set of channels tweet should be posted to"""
+        candidates = self.by_user.get('@' + tweet.screen_name, [])
+        if self.any_user:
+            candidates = candidates + self.any_user
+        if not candidates:
+            return set()
+        channels = set()
+        hits = None
+        for i in candidates:
+            if i not in self.any_keyword:
+                # only scan the text if some candidate rule needs it
+                if hits is None:
+                    hits = set()
+                    for keyword in self.matcher.find_all(tweet.texts):
+                        hits.update(self.by_keyword[keyword])
+                if i not in hits:
+                    continue
+            channels.add(self.rules[i].channel)
+        return channels
+
+def load_rules(channel=None):
+    """The default rule, rules from config.yaml and rules added from Slack"""
+    rules = [Rule(channel or config['channel'], db.user_set(), db.keyword_set())]
+    for route in config.get('routes') or []:
+        rules.append(Rule(route['channel'], route.get('users'),
+                          route.get('keywords')))
+    for channel, terms in db.get_routes().items():
+        rules.append(Rule.from_terms(channel, terms))
+    return rules
+
+_router = None
+_sources = None
+
+def get_router(channel=None):
+    """Return a Router for the current rules, rebuilt only when they change"""
+    global _router, _sources
+    channel = channel or config['channel']
+    sources = (channel, db.user_set(), db.keyword_set(), db.route_rows())
+    if _sources is None or sources[0] != _sources[0] or \
+            any(a is not b for a, b in zip(sources[1:], _sources[1:])):
+        router = Router(load_rules(channel))
+        # swap both at once so readers never see a half built router
+        _router, _sources = router, sources
+    return _router
@@ -5,16 +5,21 @@ import hashlib
 import sys
 import time
 import os
+import shlex
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request
+import aiohttp
+from aiohttp import web
 
 import db as db
+import query as query
+import metrics as metrics
 
 import logging
-logging.basicConfig(filename='twitter.log', 
-                    format='%(asctime)s SERVER %(message)s', 
-                    datefmt='%m/%d/%Y %I:%M:%S %p', 
-                    level=logging.DEBUG)
+import log as log
+# level from --log=LEVEL, see log.py
+log.setup_logging('SERVER')
 
 try:
     config = yaml.safe_load(open('config.yaml'))
@@ -24,7 +29,7 @@ except yaml.YAMLError as exc:
 SLACK_SIGNING_SECRET = os.environ['SLACK_SIGNING_SECRET']
 debug = False
 
-def verify_slack_request(timestamp, signature):
+def verify_slack_request(timestamp, signature, body):
     # mostly copied from the slackeventapi ->
     # https://github.com/slackapi/python-slack-events-api
     #
@@ -47,7 +52,7 @@ def verify_slack_request(timestamp, signature):
         # It could be a replay attack, so let's ignore it.
         return False
 
-    req = str.encode('v0:' + str(timestamp) + ':') + request.get_data()
+    req = str.encode('v0:' + str(timestamp) + ':') + body
     request_hash = 'v0=' + hmac.new(
         str.encode(SLACK_SIGNING_SECRET),
         req, hashlib.sha256
@@ -71,46 +76,148 @@ def verify_slack_request(timestamp, signature):
                 result |= ord(x) ^ ord(y)
         return result == 0
 
-def create_app():
-    app = Flask(__name__)
-
-    @app.route('/slack/events', methods=['POST'])
-    def process_slash():
-        # verify slack request
-        req_timestamp = request.headers.get('X-Slack-Request-Timestamp')
-        slack_signature = request.headers.get('X-Slack-Signature')
-        is_good = verify_slack_request(req_timestamp, slack_signature)
-
-        if is_good:
-            logging.info("Verified Slack request!")
-            logging.info("command: " + request.form['command'])
-            logging.info("text: " + request.form['text'])
-            logging.info("response_url" + request.form['response_url'])
-            logging.info("timestamp: " + request.headers.get('X-Slack-Request-Timestamp'))
-
-            # always return empty OK so Slack knows we got the message
-            if request.form['command'] == '/users':
-                return (str(db.get_users()), http.HTTPStatus.OK)
-            if request.form['command'] == '/keywords':
-                return (str(db.get_keywords()), http.HTTPStatus.OK)
-            if request.form['command'] == '/add_user':
-                db.add_user(request.form['text'])
-                return (request.form['text'] + " added to users", http.HTTPStatus.OK)
-            if request.form['command'] == '/add_keyword':
-                db.add_keyword(request.form['text'])
-                return (request.form['text'] + " added to keywords", http.HTTPStatus.OK)
-            if request.form['command'] == '/remove_user':
-                db.remove_user(request.form['text'])
-                return (request.form['text'] + " removed from users", http.HTTPStatus.OK)
-            if request.form['command'] == '/remove_keyword':
-                db.remove_keyword(request.form['text'])
-                return (request.form['text'] + " removed from keywords", http.HTTPStatus.OK)
-            if request.form['command'] == '/help':
-                return (help_message, http.HTTPStatus.OK)
-        else:
-            logging.info("Got bad HTTP request")
-            return ("", http.HTTPStatus.FORBIDDEN)
+# Slash commands ##############################################################
+# Slack gives up on a slash command after 3 seconds, so the handler only
+# checks the signature and acknowledges. The command itself runs in the
+# background and its reply is posted to the command's response_url with a
+# pooled HTTP session. Commands run one at a time on a single worker thread
+# because the CSV storage is read-modify-write.
+
+COMMANDS = ('/users', '/keywords', '/add_user', '/add_keyword', '/remove_user',
+            '/remove_keyword', '/routes', '/add_route', '/remove_route', '/help')
+
+ACK_TIME = metrics.histogram('slash_ack_seconds',
+                             'Time to verify and acknowledge a slash command')
+COMMAND_TIME = metrics.histogram('slash_command_seconds',
+                                 'Time from receiving a slash command to posting its reply',
+                                 ('command',))
+
+def run_command(command, text):
+    """Run a slash command, returning the reply text or message"""
+    if command == '/users':
+        return str(db.get_users())
+    if command == '/keywords':
+        return str(db.get_keywords())
+    if command == '/add_user':
+        db.add_user(text)
+        return text + " added to users"
+    if command == '/add_keyword':
+        # keywords can be queries, don't store one that won't compile
+        try:
+            query.compile(text)
+        except query.QueryError as e:
+            return "Could not add keyword: " + str(e)
+        db.add_keyword(text)
+        return text + " added to keywords"
+    if command == '/remove_user':
+        db.remove_user(text)
+        return text + " removed from users"
+    if command == '/remove_keyword':
+        db.remove_keyword(text)
+        return text + " removed from keywords"
+    if command == '/routes':
+        return str(db.get_routes())
+    if command == '/add_route':
+        # /add_route #channel @user keyword "a phrase" '"a query" -word'
+        terms = shlex.split(text)
+        if len(terms) < 2:
+            return "usage: /add_route #channel @user keyword ..."
+        channel = terms[0].lstrip('#')
+        # shlex takes off one level of quotes, a query keeps its own inside '...'
+        for term in terms[1:]:
+            if term.startswith('@'):
+                continue
+            try:
+                query.compile(term)
+            except query.QueryError as e:
+                return "Could not add route: " + str(e)
+        db.add_route(channel, terms[1:])
+        return " ".join(terms[1:]) + " routed to #" + channel
+    if command == '/remove_route':
+        channel = text.strip().lstrip('#')
+        db.remove_route(channel)
+        return "removed routes to #" + channel
+    if command == '/help':
+        return help_message
+    return "Unknown command " + command
+
+async def respond(app, form, received):
+    """Run a command off the event loop and post the result to response_url"""
+    loop = asyncio.get_event_loop()
+    try:
+        reply = await loop.run_in_executor(app['executor'], run_command,
+                                           form['command'], form.get('text', ''))
+    except Exception as e:
+        logging.exception("Error running %s", form['command'])
+        reply = "Sorry, {} failed: {}".format(form['command'], e)
+    if isinstance(reply, str):
+        reply = {"response_type": "ephemeral", "text": reply}
+    try:
+        async with app['http'].post(form['response_url'], json=reply) as resp:
+            if resp.status != 200:
+                logging.error("response_url returned %s for %s",
+                              resp.status, form['command'])
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error("Could not reply to %s: %s", form['command'], e)
+    command = form['command'] if form['command'] in COMMANDS else 'other'
+    COMMAND_TIME.labels(command).observe(time.perf_counter() - received)
+
+async def process_slash(request):
+    received = time.perf_counter()
+    # verify slack request
+    body = await request.read()
+    req_timestamp = request.headers.get('X-Slack-Request-Timestamp')
+    slack_signature = request.headers.get('X-Slack-Signature')
+    try:
+        is_good = verify_slack_request(req_timestamp, slack_signature, body)
+    except (TypeError, ValueError):
+        # missing or malformed headers
+        is_good = False
+    if not is_good:
+        logging.info("Got bad HTTP request")
+        return web.Response(status=http.HTTPStatus.FORBIDDEN)
+
+    form = await request.post()
+    logging.info("Verified Slack request!")
+    logging.info("command: %s", form['command'])
+    logging.info("text: %s", form.get('text', ''))
+    logging.debug("response_url: %s", form['response_url'])
+    logging.debug("timestamp: %s", req_timestamp)
+
+    # keep a reference so the task isn't collected, and for shutdown
+    tasks = request.app['tasks']
+    task = asyncio.ensure_future(respond(request.app, dict(form), received))
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    ACK_TIME.observe(time.perf_counter() - received)
+
+    # always return empty OK so Slack knows we got the message
+    return web.Response(status=http.HTTPStatus.OK)
+
+async def serve_metrics(request):
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+async def on_startup(app):
+    app['http'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=config.get('control_http_limit', 100)),
+        timeout=aiohttp.ClientTimeout(total=config.get('control_http_timeout', 10)))
+
+async def on_shutdown(app):
+    # finish replying to commands that were already acknowledged
+    if app['tasks']:
+        await asyncio.wait(list(app['tasks']))
+    await app['http'].close()
+    app['executor'].shutdown()
 
+def create_app():
+    app = web.Application()
+    app['tasks'] = set()
+    app['executor'] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='command')
+    app.router.add_post('/slack/events', process_slash)
+    app.router.add_get('/metrics', serve_metrics)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
     return app
 
 help_message = {
@@ -122,7 +229,7 @@ help_message = {
                     "type": "section",
                     "text": {
                         "type": "mrkdwn",
-                        "text": "These are the avaliable TwitterBot commands:\n>`/users` view accounts I'm following \n>`/keywords` view keywords I'm searching for\n>`/add_user` add a Twitter account\n>`/add_keyword` add a keyword to search for\n>`/remove_user` remove a Twitter account\n>`/remove_keyword` remove a keyword search term\n>`/help` print help"
+                        "text": "These are the avaliable TwitterBot commands:\n>`/users` view accounts I'm following \n>`/keywords` view keywords I'm searching for\n>`/add_user` add a Twitter account\n>`/add_keyword` add a keyword or query to search for, e.g. `/add_keyword \"deep learning\" OR #AI -hiring`\n>`/remove_user` remove a Twitter account\n>`/remove_keyword` remove a keyword search term\n>`/routes` view channel routing rules\n>`/add_route` send matches for `@users` and keywords to a channel, e.g. `/add_route #ml @GoogleAI \"machine learning\"`. Each keyword is a word or a \"phrase\", put a query in single quotes: `'\"deep learning\" -hiring'`\n>`/remove_route` remove the routing rules for a channel\n>`/help` print help"
                     }
                 }
             ]
@@ -132,4 +239,5 @@ help_message = {
 
 if __name__ == '__main__':
     app = create_app()
-    app.run(host='0.0.0.0',port=config['control_port'])
+    web.run_app(app, host='0.0.0.0', port=config['control_port'],
+                print=None, access_log=None)
@@ -1,15 +1,32 @@
 import os
+import json
+import time
 import logging
+from json.encoder import encode_basestring_ascii
 
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 import yaml
 
 import asyncio
+from collections import deque
+from threading import Event, Lock, Thread
+
+import aiohttp
 from slack_sdk.web.async_client import AsyncWebClient
 from slack_sdk.errors import SlackApiError
 
-slack_token = os.environ['SLACK_TOKEN']
+import ratelimit as ratelimit
+import outbox as outbox
+import metrics as metrics
+
+try:
+    config = yaml.safe_load(open('config.yaml'))
+except yaml.YAMLError as exc:
+    print(exc)
+
+# not required until something is actually posted (e.g. for replay.py)
+slack_token = os.environ.get('SLACK_TOKEN')
 client = WebClient(token=slack_token)
 
 ############ syncronous methods ###############################################
@@ -23,7 +40,7 @@ def write_text(message, channel='bot-dev'):
         # You will get a SlackApiError if "ok" is False
         assert e.response["ok"] is False
         assert e.response["error"] # str like 'invalid_auth', 'channel_not_found'
-        logging.error(f"Got an error: {e.response['error']}")
+        logging.error("Got an error: %s", e.response['error'])
 
 # syncronous write blocks to Slack
 def write_block(blocks=[], user_icon="", attachments=[], channel='bot-dev'):
@@ -38,22 +55,23 @@ def write_block(blocks=[], user_icon="", attachments=[], channel='bot-dev'):
         # You will get a SlackApiError if "ok" is False
         assert e.response["ok"] is False
         assert e.response["error"] # str like 'invalid_auth', 'channel_not_found'
-        logging.error(f"Got an error: {e.response['error']}")
+        logging.error("Got an error: %s", e.response['error'])
 
 ############ async methods ####################################################
-# These are included for completeness but are currently unused in the
-# main program
 
-async def post_message(message, channel='bot-dev'):
+async def post_message(message, channel='bot-dev', client=None):
+    client = client or AsyncWebClient(token=slack_token)
     try:
         response = await client.chat_postMessage(channel=channel, text=message)
         assert response["message"]["text"] == message
     except SlackApiError as e:
         assert e.response["ok"] is False
         assert e.response["error"]  # str like 'invalid_auth', 'channel_not_found'
-        print(f"Got an error: {e.response['error']}")
+        logging.error("Got an error: %s", e.response['error'])
 
-async def post_block(blocks=[], user_icon="", attachments=[], channel='bot-dev'):
+async def post_block(blocks=[], user_icon="", attachments=[], channel='bot-dev',
+                     client=None):
+    client = client or AsyncWebClient(token=slack_token)
     try:
         response = await client.chat_postMessage(channel=channel, 
                                                  blocks=blocks,
@@ -63,176 +81,485 @@ async def post_block(blocks=[], user_icon="", attachments=[], channel='bot-dev')
         # You will get a SlackApiError if "ok" is False
         assert e.response["ok"] is False
         assert e.response["error"] # str like 'invalid_auth', 'channel_not_found'
-        print(f"Got an error: {e.response['error']}")
+        logging.error("Got an error: %s", e.response['error'])
+
+############ delivery stage ###################################################
+# The tweet workers only render blocks and hand them to the sender. The
+# sender owns an event loop on its own thread with a pooled AsyncWebClient
+# and keeps up to `slack_concurrency` posts in flight at once.
+#
+# Every channel gets its own queue and token bucket so we stay inside
+# Slack's ~1 message/second/channel limit. `ratelimited` responses pause the
+# channel for Retry-After seconds and put the message back at the front of
+# its queue, other transient failures are retried with jittered backoff.
+#
+# With an outbox every message is logged to disk on submit and acknowledged
+# once Slack accepts or permanently rejects it. Whatever is left over,
+# including posts we gave up retrying, is sent again by the next sender.
+
+POSTS = metrics.counter('slack_posts_total', 'Slack posts by outcome', ('result',))
+SLACK_ERRORS = metrics.counter('slack_errors_total',
+                               'Failed Slack posts by error code', ('error',))
+POST_TIME = metrics.histogram('stage_seconds', 'Time spent in each pipeline stage',
+                              ('stage',)).labels('post')
+
+# errors worth retrying, everything else is dropped after logging
+RETRY_ERRORS = ('internal_error', 'fatal_error', 'service_unavailable',
+                'request_timeout')
+
+class _Channel:
+    """Pending messages and rate limit state for one Slack channel"""
+
+    def __init__(self, rate, burst):
+        self.queue = deque()
+        self.bucket = ratelimit.TokenBucket(rate, burst)
+        self.wakeup = asyncio.Event()
+        self.inflight = 0
+
+class SlackSender:
+    """Deliver rendered messages to Slack from a dedicated event loop"""
+
+    def __init__(self, token=None, concurrency=None, rate=None, burst=None,
+                 max_retries=None, outbox=None):
+        self.token = token or slack_token
+        self.concurrency = concurrency or config.get('slack_concurrency', 8)
+        self.rate = rate or config.get('slack_rate', 1.0)
+        self.burst = burst or config.get('slack_burst', 3)
+        self.max_retries = max_retries or config.get('slack_max_retries', 5)
+        self.outbox = outbox
+        self.loop = asyncio.new_event_loop()
+        self.ready = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.channels = {}
+        self.pending = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+        if self.outbox is not None:
+            for entry_id, message in self.outbox.pending():
+                self._submit_threadsafe(dict(message, attempts=0,
+                                             outbox_ids=[entry_id]))
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._main())
+        self.loop.close()
+
+    async def _main(self):
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.closing = asyncio.Event()
+        self.drained = asyncio.Event()
+        # one pooled session for every post instead of a session per request
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency))
+        self.client = AsyncWebClient(token=self.token, session=session)
+        self.ready.set()
+
+        await self.closing.wait()
+        # drain everything that was submitted before close()
+        if self.pending:
+            await self.drained.wait()
+        for ch in self.channels.values():
+            ch.task.cancel()
+        await asyncio.gather(*(ch.task for ch in self.channels.values()),
+                             return_exceptions=True)
+        await session.close()
+
+    def _enqueue(self, channel, message, front=False):
+        ch = self.channels.get(channel)
+        if ch is None:
+            ch = self.channels[channel] = _Channel(self.rate, self.burst)
+            ch.task = asyncio.ensure_future(self._dispatch(ch))
+        if front:
+            ch.queue.appendleft(message)
+        else:
+            ch.queue.append(message)
+        ch.wakeup.set()
+
+    def _finish(self, message, sent, keep=False):
+        # keep leaves the message in the outbox to try again after a restart
+        if self.outbox is not None and not keep:
+            for entry_id in message['outbox_ids']:
+                self.outbox.ack(entry_id)
+        self.pending -= 1
+        if sent:
+            self.sent += 1
+            POSTS.labels('sent').inc()
+        else:
+            self.dropped += 1
+            POSTS.labels('dropped').inc()
+        if not self.pending:
+            self.drained.set()
+
+    async def _dispatch(self, ch):
+        """Release messages for one channel as fast as its bucket allows"""
+        while True:
+            if not ch.queue:
+                ch.wakeup.clear()
+                await ch.wakeup.wait()
+                continue
+            wait = ch.bucket.take(self.loop.time())
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            await self.slots.acquire()
+            # the queue may have been emptied while we waited for a slot
+            if not ch.queue:
+                self.slots.release()
+                continue
+            message = ch.queue.popleft()
+            ch.inflight += 1
+            asyncio.ensure_future(self._deliver(ch, message))
+
+    async def _deliver(self, ch, message):
+        retry_in = None
+        start = time.perf_counter()
+        try:
+            await self.client.chat_postMessage(channel=message['channel'],
+                                               blocks=message['blocks'],
+                                               attachments=message['attachments'],
+                                               icon_url=message['user_icon'])
+            POST_TIME.observe(time.perf_counter() - start)
+            self._finish(message, True)
+        except SlackApiError as e:
+            POST_TIME.observe(time.perf_counter() - start)
+            error = e.response.get('error')
+            SLACK_ERRORS.labels(error).inc()
+            if error == 'ratelimited':
+                retry_after = float(e.response.headers.get('Retry-After', 1))
+                logging.warning("Rate limited on %s, retrying in %ss",
+                                message['channel'], retry_after)
+                ch.bucket.pause(self.loop.time(), retry_after)
+                self._enqueue(message['channel'], message, front=True)
+            elif error in RETRY_ERRORS:
+                retry_in = ratelimit.backoff_delay(message['attempts'])
+            else:
+                logging.error("Got an error: %s", error)
+                self._finish(message, False)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            SLACK_ERRORS.labels('connection').inc()
+            logging.warning("Error posting to Slack: %s", e)
+            retry_in = ratelimit.backoff_delay(message['attempts'])
+        except Exception as e:
+            # keep it in the outbox so it is sent again on the next start
+            SLACK_ERRORS.labels('exception').inc()
+            logging.error("Unexpected error posting to Slack: %r", e)
+            self._finish(message, False, keep=True)
+        finally:
+            ch.inflight -= 1
+            self.slots.release()
+
+        if retry_in is not None:
+            message['attempts'] += 1
+            if message['attempts'] > self.max_retries:
+                logging.error("Giving up on Slack post to %s after %d attempts",
+                              message['channel'], message['attempts'])
+                self._finish(message, False, keep=True)
+            else:
+                self.loop.call_later(retry_in, self._enqueue,
+                                     message['channel'], message)
+
+    def submit(self, blocks=[], user_icon="", attachments=[], channel='bot-dev',
+               outbox_ids=None):
+        """
+        Queue a message for delivery, safe to call from any thread.
+        outbox_ids are outbox entries the message stands in for (e.g. the
+        matches in a digest), acked once it is sent instead of logging it
+        """
+        message = dict(blocks=blocks, user_icon=user_icon,
+                       attachments=attachments, channel=channel)
+        if outbox_ids is not None:
+            message['outbox_ids'] = list(outbox_ids)
+        elif self.outbox is not None:
+            message['outbox_ids'] = [self.outbox.append(dict(message))]
+        message['attempts'] = 0
+        self._submit_threadsafe(message)
+
+    def _submit_threadsafe(self, message):
+        self.loop.call_soon_threadsafe(self._submit, message)
+
+    def _submit(self, message):
+        self.pending += 1
+        self.drained.clear()
+        self._enqueue(message['channel'], message)
+
+    def queue_depths(self):
+        """Return {channel: messages waiting or in flight}"""
+        return {name: len(ch.queue) + ch.inflight
+                for name, ch in list(self.channels.items())}
+
+    def close(self, timeout=None):
+        """Stop accepting work and wait for pending posts to be delivered"""
+        if not self.thread.is_alive():
+            return
+        logging.info("Draining pending Slack posts")
+        self.loop.call_soon_threadsafe(self.closing.set)
+        self.thread.join(timeout)
+        if self.outbox is not None:
+            # anything still undelivered stays in the file for next time
+            self.outbox.close()
+
+############ digest mode ######################################################
+# During busy periods matches for a channel are collected and posted as one
+# combined message, split so no post goes over Slack's 50 block limit. The
+# first match after a quiet spell is posted straight away, and nothing is
+# held back longer than `window` seconds. Buffered matches are written to
+# the sender's outbox straight away and acked once the combined post that
+# carries them is sent, so a crash inside the window doesn't lose them:
+# they are posted one by one on the next start.
+
+MAX_BLOCKS = 50
+
+class Digester:
+    """Coalesce messages per channel in front of a SlackSender"""
+
+    def __init__(self, sender, window=None, max_messages=None):
+        self.sender = sender
+        self.window = window or config.get('digest_window', 30)
+        self.max_messages = max_messages or config.get('digest_max_messages', 10)
+        self.lock = Lock()
+        # channel -> [first queued time, [blocks, ...], [outbox id, ...]]
+        self.buffers = {}
+        self.last_post = {}
+        self.stopping = Event()
+        self.timer = Thread(target=self._run, daemon=True)
+        self.timer.start()
+
+    def submit(self, blocks=[], user_icon="", attachments=[], channel='bot-dev'):
+        now = time.monotonic()
+        with self.lock:
+            buffered = self.buffers.get(channel)
+            if buffered is None and \
+                    now - self.last_post.get(channel, -self.window) >= self.window:
+                # quiet channel, don't make anyone wait
+                self.last_post[channel] = now
+                self.sender.submit(blocks, user_icon=user_icon,
+                                   attachments=attachments, channel=channel)
+                return
+            if buffered is None:
+                buffered = self.buffers[channel] = [now, [], []]
+            buffered[1].append(blocks)
+            box = self.sender.outbox
+            if box is not None:
+                buffered[2].append(box.append(dict(blocks=blocks, user_icon=user_icon,
+                                                   attachments=attachments,
+                                                   channel=channel)))
+            if len(buffered[1]) >= self.max_messages:
+                self._flush(channel, now)
+
+    def _run(self):
+        while not self.stopping.wait(min(1.0, self.window / 4.0)):
+            now = time.monotonic()
+            with self.lock:
+                for channel, (first, _, _) in list(self.buffers.items()):
+                    if now - first >= self.window:
+                        self._flush(channel, now)
+
+    def _flush(self, channel, now):
+        """Post everything buffered for channel, called with the lock held"""
+        first, messages, entry_ids = self.buffers.pop(channel)
+        self.last_post[channel] = now
+        for blocks, included in pack(messages):
+            # the post stands in for its matches' outbox entries
+            outbox_ids = [entry_ids[i] for i in included] if entry_ids else None
+            self.sender.submit(blocks, channel=channel, outbox_ids=outbox_ids)
+
+    def queue_depths(self):
+        depths = self.sender.queue_depths()
+        with self.lock:
+            for channel, (_, messages, _) in self.buffers.items():
+                depths[channel] = depths.get(channel, 0) + len(messages)
+        return depths
+
+    def close(self, timeout=None):
+        """Flush every buffered digest, then drain the sender"""
+        self.stopping.set()
+        with self.lock:
+            for channel in list(self.buffers):
+                self._flush(channel, time.monotonic())
+        self.sender.close(timeout)
+
+def combine(messages):
+    """
+    Merge rendered messages into as few block lists as possible,
+    keeping each under MAX_BLOCKS and only splitting a message that
+    is too long for a post of its own
+    """
+    return [post for post, _ in pack(messages)]
+
+def pack(messages):
+    """combine, returning (blocks, indexes of the messages in it) for each post"""
+    posts = []
+    current = []
+    included = []
+    room = MAX_BLOCKS - 1
+    for i, blocks in enumerate(messages):
+        if isinstance(blocks, str):
+            blocks = json.loads(blocks)
+        if len(blocks) > room:
+            logging.warning("Message of %d blocks split over %d digest posts",
+                            len(blocks), -(-len(blocks) // room))
+            if current:
+                posts.append((current, included))
+            # only the last part acks the outbox entry, once it all went out
+            for start in range(0, len(blocks), room):
+                last = start + room >= len(blocks)
+                posts.append(([None] + blocks[start:start + room], [i] if last else []))
+            current = []
+            continue
+        # the header, current[0], is already counted
+        if current and len(current) + len(blocks) > MAX_BLOCKS:
+            posts.append((current, included))
+            current = []
+        if not current:
+            current = [None]
+            included = []
+        current.extend(blocks)
+        included.append(i)
+    if current:
+        posts.append((current, included))
+    for post, _ in posts:
+        tweets = sum(1 for b in post if b is not None and b.get('type') == 'divider')
+        # the leading parts of a split message end without a divider
+        header = "*{} matching tweets*".format(tweets) if tweets else "_continued_"
+        post[0] = {"type": "section",
+                   "text": {"type": "mrkdwn", "text": header}}
+    return posts
+
+_sender = None
+_sender_lock = Lock()
+
+def get_sender():
+    """
+    Return the process wide sender, starting it on first use.
+    With `outbox_file` set messages are logged there until delivered,
+    with `digest` enabled in config.yaml it is wrapped in a Digester.
+    """
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            box = None
+            if config.get('outbox_file'):
+                box = outbox.Outbox(
+                    config['outbox_file'],
+                    sync_interval=config.get('outbox_sync_interval', 0.2),
+                    compact_after=config.get('outbox_compact_after', 1000))
+            _sender = SlackSender(outbox=box).start()
+            metrics.gauge('slack_queue_depth', 'Slack posts waiting or in flight',
+                          ('channel',), fn=_sender.queue_depths)
+            if box is not None:
+                metrics.gauge('outbox_pending', 'Posts in the outbox not yet delivered',
+                              fn=lambda: len(box.entries))
+            if config.get('digest', False):
+                _sender = Digester(_sender)
+                metrics.gauge('slack_queue_depth', 'Slack posts waiting or in flight',
+                              ('channel',), fn=_sender.queue_depths)
+    return _sender
 
 # Formating Slack messages ####################################################
 
-def build_message(t):
-    """Build a Slack message as JSON 'blocks'"""
-    
-    if hasattr(t, 'quoted_status'):
-        quote_template = [
-        {
-         "type":"section",
-         "text":{
-            "type": "mrkdwn",
-            "text": "<https://twitter.com/{}|@{}> quote tweeted:".format(t.author.screen_name, t.author.screen_name)
-         }
-        },
-        {
-         "type": "section",
-         "text": {
-             "type": "mrkdwn",
-             "text": "{}".format(t.text.split(' https://')[0])
-         }
-        },
-        {
-         "type":"context",
-         "elements":[
-            {
-               "type":"image",
-               "image_url":"{}".format(t.quoted_status.user.profile_image_url),
-                "alt_text": "@{}".format(t.quoted_status.user.screen_name)
-            },
-            {
-               "type":"mrkdwn",
-               "text":"<https://twitter.com/{}|@{}> tweeted: ".format(t.quoted_status.user.screen_name, t.quoted_status.user.screen_name)
-            },
-            {
-                "type": "mrkdwn",
-                "text": "{}".format(t.quoted_status.text.split('https://')[0])
-            }
-         ]
-        },
-        ]
-        if 'media' in t.entities:
-            quote_template.append(
-                {"type": "image",
-                 "image_url": "{}".format(t.entities['media'][0]['media_url']),
-                 "alt_text": "image"
-                },
-            )
-        if 'media' in t.quoted_status.entities:
-            quote_template.append(
-                {"type": "image",
-                 "image_url": "{}".format(t.quoted_status.entities['media'][0]['media_url']),
-                 "alt_text": "image"
-                },
-            )
-        quote_template.append(
-            {
-             "type":"section",
-             "text":{
-                "type": "mrkdwn",
-                "text": "https://twitter.com/{}/status/{}".format(t.author.screen_name, t.id)
-             }
-            },
-        )
-        quote_template.append(
-            {
-                "type": "divider"
-            }
-        )
-        return quote_template
-    if hasattr(t, 'retweeted_status'):
-        re_template = [
+# The block layouts are serialized to JSON once at import. SLOT marks the
+# variable fields, which become %s positions in the compiled template, so
+# rendering a tweet only escapes and fills in those fields.
+
+SLOT = '\x00'
+
+def compile_template(block):
+    """Serialize a block with SLOT placeholders into a %-format string"""
+    text = json.dumps(block, separators=(',', ':')).replace('%', '%%')
+    return text.replace('\\u0000', '%s')
+
+def escape(value):
+    """Escape a value for a slot inside a JSON string"""
+    return encode_basestring_ascii(value)[1:-1]
+
+HEADER_TEMPLATE = compile_template(
+    {
+     "type":"section",
+     "text":{
+        "type": "mrkdwn",
+        "text": "<https://twitter.com/\x00|@\x00> \x00:"
+     }
+    })
+
+TEXT_TEMPLATE = compile_template(
+    {
+     "type": "section",
+     "text": {
+         "type": "mrkdwn",
+         "text": SLOT
+     }
+    })
+
+CONTEXT_TEMPLATE = compile_template(
+    {
+     "type":"context",
+     "elements":[
         {
-         "type":"section",
-         "text":{
-            "type": "mrkdwn",
-            "text": "<https://twitter.com/{}|@{}> re-tweeted:".format(t.author.screen_name, t.author.screen_name)
-         }
+           "type":"image",
+           "image_url": SLOT,
+           "alt_text": "@\x00"
         },
         {
-         "type":"context",
-         "elements":[
-            {
-               "type":"image",
-               "image_url":"{}".format(t.retweeted_status.user.profile_image_url),
-                "alt_text": "@{}".format(t.retweeted_status.user.screen_name)
-            },
-            {
-               "type":"mrkdwn",
-               "text":"<https://twitter.com/{}|@{}> tweeted: ".format(t.retweeted_status.user.screen_name, t.retweeted_status.user.screen_name)
-            },
-            {
-                "type": "mrkdwn",
-                "text": "{}".format(t.retweeted_status.text.split('https://')[0])
-            }
-         ]
+           "type":"mrkdwn",
+           "text":"<https://twitter.com/\x00|@\x00> tweeted: "
         },
-        ]
-        if 'media' in t.entities:
-            re_template.append(
-                {"type": "image",
-                 "image_url": "{}".format(t.entities['media'][0]['media_url']),
-                 "alt_text": "image"
-                },
-            )
-        if 'media' in t.retweeted_status.entities:
-            re_template.append(
-                {"type": "image",
-                 "image_url": "{}".format(t.retweeted_status.entities['media'][0]['media_url']),
-                 "alt_text": "image"
-                },
-            )
-        re_template.append(
-            {
-         "type":"section",
-         "text":{
-            "type": "mrkdwn",
-            "text": "https://twitter.com/{}/status/{}".format(t.author.screen_name, t.id)
-         }
-        },
-        )
-        re_template.append(
-            {
-                "type": "divider"
-            }
-        )
-        return re_template
-    else:
-        template = [
         {
-         "type":"section",
-         "text":{
             "type": "mrkdwn",
-            "text": "<https://twitter.com/{}|@{}> tweeted:".format(t.author.screen_name, t.author.screen_name)
-         }
-        },
-        {
-         "type": "section",
-         "text": {
-             "type": "mrkdwn",
-             "text": "{}".format(t.text.split('https://')[0])
-         }
-        },
-        ]
-        if 'media' in t.entities:
-            template.append(
-                {"type": "image",
-                 "image_url": "{}".format(t.entities['media'][0]['media_url']),
-                 "alt_text": "image"
-                },
-            )
-        template.append(
-            {
-             "type":"section",
-             "text":{
-                "type": "mrkdwn",
-                "text": "https://twitter.com/{}/status/{}".format(t.author.screen_name, t.id)
-             }
-            },
-        )
-        template.append(
-            {
-                "type": "divider"
-            }
-        )
-        return template
+            "text": SLOT
+        }
+     ]
+    })
+
+IMAGE_TEMPLATE = compile_template(
+    {"type": "image",
+     "image_url": SLOT,
+     "alt_text": "image"
+    })
+
+LINK_TEMPLATE = compile_template(
+    {
+     "type":"section",
+     "text":{
+        "type": "mrkdwn",
+        "text": "https://twitter.com/\x00/status/\x00"
+     }
+    })
+
+DIVIDER = compile_template({"type": "divider"})
+
+VERBS = {'tweet': 'tweeted', 'quote': 'quote tweeted', 'retweet': 're-tweeted'}
+
+def build_message(t):
+    """
+    Build a Slack message from a TweetRecord as serialized JSON 'blocks',
+    ready to hand to chat_postMessage
+    """
+    # screen names are [A-Za-z0-9_] and ids are digits, so only the
+    # free text and URLs need escaping
+    name = t.screen_name
+    blocks = [HEADER_TEMPLATE % (name, name, VERBS[t.kind])]
+    if t.kind != 'retweet':
+        blocks.append(TEXT_TEMPLATE % escape(t.display))
+    inner = t.inner
+    if inner is not None:
+        blocks.append(CONTEXT_TEMPLATE % (escape(inner.user_icon or ''),
+                                          inner.screen_name,
+                                          inner.screen_name, inner.screen_name,
+                                          escape(inner.display)))
+    if t.media_url:
+        blocks.append(IMAGE_TEMPLATE % escape(t.media_url))
+    if inner is not None and inner.media_url:
+        blocks.append(IMAGE_TEMPLATE % escape(inner.media_url))
+    blocks.append(LINK_TEMPLATE % (name, t.id))
+    blocks.append(DIVIDER)
+    return '[' + ','.join(blocks) + ']'
 
 if __name__ == "__main__":
 
     # test basic functionality
-	client = AsyncWebClient(token=slack_token)
 	asyncio.run(post_message("Posted asynchronously", channel='bot-dev'))
@@ -0,0 +1,359 @@
+import bisect
+import hashlib
+import time
+from threading import Event, Lock, Thread
+import logging
+
+import tweepy
+import metrics as metrics
+import ratelimit as ratelimit
+
+# Stream supervisor ###########################################################
+# One place owns the stream connection. tweepy's own retry loop is turned
+# off: every connection reports why it ended (an HTTP error, a timeout or
+# network error, or Twitter closing it) and the supervisor waits the delay
+# Twitter recommends for that kind of failure (see ratelimit.py) before
+# connecting again. The listener, its queue and workers are kept across
+# reconnects, only the connection is replaced.
+#
+# The failure count for the backoff is reset once a connection has stayed
+# up for `stable_after` seconds, so a stream that was healthy for hours
+# and then dropped is reconnected at once.
+#
+# on_lost(name, ids) is called when the stream goes down (or is replaced
+# to follow new ids) and on_recovered(name, ids) once it is connected
+# again, and on the first connection, e.g. to backfill the gap.
+
+DISCONNECTS = metrics.counter('stream_disconnects_total',
+                              'Stream connections lost, by kind of failure',
+                              ('kind',))
+RECONNECTS = metrics.counter('stream_reconnects_total', 'Stream reconnects')
+RECOVERY_TIME = metrics.histogram('stream_recovery_seconds',
+                                  'Time from losing the stream to being connected again',
+                                  buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                                           60.0, 120.0, 300.0, 600.0, 1200.0))
+
+class _Connection(tweepy.StreamListener):
+    """
+    Listener for a single connection: passes the data on to the shared
+    listener and records why the connection ended
+    """
+
+    def __init__(self, listener, supervisor):
+        super(_Connection, self).__init__()
+        self.listener = listener
+        self.supervisor = supervisor
+        # (kind, detail) once the connection has failed
+        self.reason = None
+        self.connected_at = None
+
+    def on_connect(self):
+        self.connected_at = time.monotonic()
+        self.supervisor.connected(self)
+
+    def on_data(self, raw_data):
+        return self.listener.on_data(raw_data)
+
+    def on_error(self, status_code):
+        kind = 'rate_limit' if status_code in (420, 429) else 'http'
+        self.reason = (kind, status_code)
+        # stop tweepy retrying, the supervisor decides when to reconnect
+        return False
+
+    def on_timeout(self):
+        self.reason = ('network', 'timeout')
+        return False
+
+    def on_exception(self, exception):
+        self.reason = ('network', exception)
+
+class StreamSupervisor:
+    """Connect a stream following ids and keep it connected"""
+
+    def __init__(self, listener, new_stream, ids=(), name='stream',
+                 stable_after=30, jitter=0.2, on_lost=None, on_recovered=None):
+        # new_stream(connection_listener) returns an unconnected tweepy Stream
+        self.listener = listener
+        self.new_stream = new_stream
+        self.ids = list(ids)
+        self.name = name
+        self.stable_after = stable_after
+        self.jitter = jitter
+        self.on_lost = on_lost
+        self.on_recovered = on_recovered
+        self.lock = Lock()
+        # set when the current connection ends or should be replaced
+        self.done = Event()
+        self.stopped = Event()
+        self.restart = False
+        self.backing_off = False
+        self.stream = None
+        self.connection = None
+        self.thread = None
+
+        # backoff state
+        self.kind = None
+        self.attempts = 0
+        self.down_since = None
+        # tweets may have been missed since the last connection
+        self.gap = True
+
+        # counters
+        self.connects = 0
+        self.disconnects = {}
+
+    def start(self):
+        self.thread = Thread(target=self._run, daemon=True,
+                             name='{}-supervisor'.format(self.name))
+        self.thread.start()
+        return self
+
+    def _serve(self, stream, connection, ids):
+        """Run one connection until it ends, in its own thread"""
+        try:
+            stream.filter(follow=ids, stall_warnings=False)
+        except Exception as e:
+            if connection.reason is None:
+                connection.reason = ('network', e)
+        with self.lock:
+            # a connection replaced by reconnect() ends on its own time
+            if connection is self.connection:
+                self.done.set()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if self.stopped.is_set():
+                    break
+                self.restart = False
+                self.done.clear()
+                ids = list(self.ids)
+                connection = self.connection = _Connection(self.listener, self)
+                stream = self.stream = self.new_stream(connection)
+            logging.info("Connecting %s following %d accounts", self.name, len(ids))
+            Thread(target=self._serve, args=(stream, connection, ids), daemon=True,
+                   name=self.name).start()
+            self.done.wait()
+
+            with self.lock:
+                if self.stopped.is_set():
+                    break
+                restart = self.restart
+                self.backing_off = not restart
+                self.gap = True
+            self._lost(ids)
+            if restart:
+                # disconnected on purpose to pick up new ids
+                continue
+            delay = self._failed(connection)
+            self.stopped.wait(delay)
+            with self.lock:
+                self.backing_off = False
+
+    def _failed(self, connection):
+        """Record why the connection ended, return the delay before reconnecting"""
+        kind, detail = connection.reason or ('closed', None)
+        now = time.monotonic()
+        stable = (connection.connected_at is not None
+                  and now - connection.connected_at >= self.stable_after)
+        if stable or kind != self.kind:
+            self.attempts = 0
+        if self.down_since is None:
+            self.down_since = now
+        delay = ratelimit.reconnect_delay(kind, self.attempts, self.jitter)
+        self.kind = kind
+        self.attempts += 1
+        self.disconnects[kind] = self.disconnects.get(kind, 0) + 1
+        DISCONNECTS.labels(kind).inc()
+        RECONNECTS.inc()
+        log = logging.error if kind in ('http', 'rate_limit') else logging.warning
+        log("%s lost (%s: %s), reconnecting in %.2fs", self.name, kind, detail, delay)
+        return delay
+
+    def _lost(self, ids):
+        if self.on_lost is None:
+            return
+        try:
+            self.on_lost(self.name, ids)
+        except Exception as e:
+            logging.error("Error in %s on_lost: %s", self.name, e)
+
+    def connected(self, connection):
+        """Called by a connection once Twitter has accepted it"""
+        if connection is not self.connection:
+            # replaced while it was connecting
+            return
+        self.connects += 1
+        if self.down_since is not None:
+            down = time.monotonic() - self.down_since
+            RECOVERY_TIME.observe(down)
+            logging.info("%s reconnected after %.2fs", self.name, down)
+            self.down_since = None
+        else:
+            logging.info("%s connected", self.name)
+        if self.gap:
+            self.gap = False
+            if self.on_recovered is not None:
+                try:
+                    self.on_recovered(self.name, list(self.ids))
+                except Exception as e:
+                    logging.error("Error in %s on_recovered: %s", self.name, e)
+
+    def reconnect(self, ids):
+        """Follow a new list of ids, reconnecting unless already waiting to"""
+        with self.lock:
+            self.ids = list(ids)
+            if self.backing_off or self.stream is None:
+                # the next attempt uses the new ids, without cutting the backoff short
+                return
+            self.restart = True
+            stream = self.stream
+            self.done.set()
+        stream.disconnect()
+
+    def stats(self):
+        return {'name': self.name,
+                'connects': self.connects,
+                'disconnects': dict(self.disconnects),
+                'attempts': self.attempts,
+                'down': self.down_since is not None}
+
+    def stop(self, timeout=10):
+        """Disconnect and stop reconnecting"""
+        with self.lock:
+            self.stopped.set()
+            self.done.set()
+            stream = self.stream
+        if stream is not None:
+            stream.disconnect()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+# Sharding ####################################################################
+# A filter connection can only follow so many accounts. The stream manager
+# splits the followed ids across `connections` supervised streams with a
+# consistent hash, so adding or removing an account only reconnects the
+# shard it hashes to and the other connections stay up. The hash doesn't
+# split the ids evenly, so an id whose shard already has `follow_limit`
+# ids goes to the next shard round the ring with room (a bounded-load
+# consistent hash). Every shard feeds the same listener, and so the same
+# queue; the listener drops tweets that arrive on more than one connection.
+
+def _hash(text):
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+
+class HashRing:
+    """Consistent hash of ids onto shards 0..shards-1"""
+
+    def __init__(self, shards, replicas=100):
+        # each shard owns `replicas` points so the ids spread evenly
+        points = sorted((_hash('{}:{}'.format(shard, r)), shard)
+                        for shard in range(shards) for r in range(replicas))
+        self.shards = shards
+        self.points = [point for point, _ in points]
+        self.owners = [shard for _, shard in points]
+
+    def shard(self, key):
+        i = bisect.bisect(self.points, _hash(str(key)))
+        return self.owners[i % len(self.points)]
+
+    def walk(self, key):
+        """Every shard once, from the one key hashes to on round the ring"""
+        n = len(self.points)
+        i = bisect.bisect(self.points, _hash(str(key)))
+        seen = set()
+        for j in range(i, i + n):
+            owner = self.owners[j % n]
+            if owner not in seen:
+                seen.add(owner)
+                yield owner
+                if len(seen) == self.shards:
+                    return
+
+class StreamManager:
+    """Follow ids over several supervised connections"""
+
+    def __init__(self, listener, new_stream, ids=(), connections=1,
+                 follow_limit=5000, **options):
+        # new_stream(connection_listener, shard) returns an unconnected
+        # stream for a shard, each shard needs its own credentials.
+        # options are passed on to every StreamSupervisor
+        self.listener = listener
+        self.new_stream = new_stream
+        self.connections = connections
+        self.follow_limit = follow_limit
+        self.options = options
+        self.ring = HashRing(connections)
+        self.lock = Lock()
+        self.shards = [None] * connections
+        self.ids = self.split(ids)
+        metrics.gauge('stream_follows', 'Accounts followed by each stream connection',
+                      ('shard',), fn=lambda: {str(i): len(ids)
+                                              for i, ids in enumerate(self.ids)})
+
+    def split(self, ids):
+        """The ids for each shard, at most follow_limit each if they fit"""
+        ids = sorted(set(ids))
+        limit = self.follow_limit
+        if len(ids) > limit * self.connections:
+            logging.warning("Following %d accounts needs more than %d connections of %d "
+                            "accounts each, raise stream_connections",
+                            len(ids), self.connections, limit)
+            # over the limit anyway, at least spread them evenly
+            limit = -(-len(ids) // self.connections)
+        shards = [[] for _ in range(self.connections)]
+        # sorted so the same ids always land on the same shards
+        for user_id in ids:
+            for i in self.ring.walk(user_id):
+                if len(shards[i]) < limit:
+                    shards[i].append(user_id)
+                    break
+        return shards
+
+    def _supervisor(self, i, ids):
+        return StreamSupervisor(self.listener,
+                                lambda listener: self.new_stream(listener, i), ids,
+                                name='stream-{}'.format(i), **self.options).start()
+
+    def start(self):
+        with self.lock:
+            for i, ids in enumerate(self.ids):
+                # Twitter refuses a filter without anything to follow
+                if ids:
+                    self.shards[i] = self._supervisor(i, ids)
+        return self
+
+    def reconnect(self, ids):
+        """Follow a new list of ids, returns the shards that had to reconnect"""
+        changed = []
+        stopped = []
+        with self.lock:
+            new = self.split(ids)
+            for i, (old_ids, new_ids) in enumerate(zip(self.ids, new)):
+                if set(old_ids) == set(new_ids):
+                    continue
+                changed.append(i)
+                shard = self.shards[i]
+                if not new_ids:
+                    if shard is not None:
+                        stopped.append(shard)
+                    self.shards[i] = None
+                elif shard is None:
+                    self.shards[i] = self._supervisor(i, new_ids)
+                else:
+                    shard.reconnect(new_ids)
+            self.ids = new
+        # stop() joins the supervisor thread, don't hold the lock meanwhile
+        for shard in stopped:
+            shard.stop()
+        return changed
+
+    def stats(self):
+        return [shard.stats() if shard is not None else {'name': 'stream-{}'.format(i)}
+                for i, shard in enumerate(self.shards)]
+
+    def stop(self, timeout=10):
+        with self.lock:
+            shards = [shard for shard in self.shards if shard is not None]
+        for shard in shards:
+            shard.stop(timeout)
@@ -0,0 +1,128 @@
+import json
+import os
+from collections import deque
+from threading import Condition
+import logging
+
+# Bounded tweet queue #########################################################
+# put() never blocks, so on_status can't stall the socket reader. When the
+# queue is full the overflow policy decides what gives:
+#   drop-oldest  discard the oldest queued tweet to make room
+#   drop-newest  discard the incoming tweet
+#   spill        append to a JSON lines file and read it back in order
+
+POLICIES = ('drop-oldest', 'drop-newest', 'spill')
+
+class TweetQueue:
+    """Bounded, non-blocking FIFO with overflow accounting"""
+
+    def __init__(self, maxsize=10000, policy='drop-oldest', spill_file=None,
+                 dump=None, load=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy: {}".format(policy))
+        if policy == 'spill' and not spill_file:
+            raise ValueError("The spill policy needs a spill_file")
+        if maxsize < 1:
+            raise ValueError("Queue size must be at least 1, got {}".format(maxsize))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_file = spill_file
+        # dump/load convert items to and from something json can handle
+        self.dump = dump or (lambda item: item)
+        self.load = load or (lambda data: data)
+        self.items = deque()
+        self.not_empty = Condition()
+        self._spill = None
+        self._spilled = 0
+
+        # counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.high_water = 0
+
+    def put(self, item):
+        """Add item without ever blocking the caller"""
+        with self.not_empty:
+            self.enqueued += 1
+            if self._spilled or len(self.items) >= self.maxsize:
+                if self.policy == 'drop-newest':
+                    self.dropped += 1
+                    return False
+                if self.policy == 'drop-oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                elif self.policy == 'spill':
+                    self._spill_item(item)
+                    self.not_empty.notify()
+                    return True
+            self.items.append(item)
+            self.high_water = max(self.high_water, self.qsize())
+            self.not_empty.notify()
+            return True
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the oldest item, None if the timeout expires"""
+        with self.not_empty:
+            if block:
+                self.not_empty.wait_for(lambda: self.items or self._spilled,
+                                        timeout)
+            if self.items:
+                return self.items.popleft()
+            if self._spilled:
+                return self._unspill_item()
+            return None
+
+    def qsize(self):
+        return len(self.items) + self._spilled
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def clear(self):
+        """Discard everything queued, counting it as dropped"""
+        with self.not_empty:
+            self.dropped += self.qsize()
+            self.items.clear()
+            self._reset_spill()
+
+    def stats(self):
+        return {'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'depth': self.qsize(),
+                'high_water': self.high_water}
+
+    # spill file handling, always called with the lock held ###################
+
+    def _spill_item(self, item):
+        if self._spill is None:
+            self._spill = open(self.spill_file, 'w+')
+            self._read_pos = 0
+        self._spill.seek(0, os.SEEK_END)
+        self._spill.write(json.dumps(self.dump(item)) + '\n')
+        self._spilled += 1
+        self.spilled += 1
+        self.high_water = max(self.high_water, self.qsize())
+
+    def _unspill_item(self):
+        self._spill.flush()
+        self._spill.seek(self._read_pos)
+        line = self._spill.readline()
+        self._read_pos = self._spill.tell()
+        self._spilled -= 1
+        if not self._spilled:
+            # reader caught up with the writer, start the file over
+            self._reset_spill()
+        try:
+            return self.load(json.loads(line))
+        except ValueError as e:
+            logging.error("Bad spilled tweet: %s", e)
+            return None
+
+    def _reset_spill(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            os.remove(self.spill_file)
+        self._spilled = 0
@@ -1,40 +1,96 @@
-import sys
+import json
 import os
 import time
-from queue import Queue
-from threading import Thread
 
 from tweepy import Stream
 import tweepy
 import db as db
 import slack as slack
+import lookup as lookup
+import tweetqueue as tweetqueue
+import workers as workers
+import ingest as ingest
+import record as record
+import dedup as dedup
+import routing as routing
+import filterpool as filterpool
+import metrics as metrics
+import supervisor as supervisor
+import backfill as backfill
 import yaml
-from watchgod import run_process, watch
+from watchgod import watch
 from watchgod.watcher import DefaultDirWatcher
 from http.client import IncompleteRead as http_incompleteRead
 from urllib3.exceptions import IncompleteRead as urllib3_incompleteRead
 
 import logging
-logging.basicConfig(filename='twitter.log', 
-                    format='%(asctime)s TWITTER %(message)s', 
-                    datefmt='%m/%d/%Y %I:%M:%S %p', 
-                    level=logging.DEBUG)
+import log as log
+# level from --log=LEVEL, see log.py
+log.setup_logging('TWITTER')
 
 try:
     config = yaml.safe_load(open('config.yaml'))
 except yaml.YAMLError as exc:
     print(exc)
 
-TWITTER_CONSUMER_KEY = os.environ['TWITTER_CONSUMER_KEY']
-TWITTER_CONSUMER_SECRET = os.environ['TWITTER_CONSUMER_SECRET']
-TWITTER_ACCESS_TOKEN = os.environ['TWITTER_ACCESS_TOKEN']
-TWITTER_ACCESS_TOKEN_SECRET = os.environ['TWITTER_ACCESS_TOKEN_SECRET']
-
 POST_CHANNEL = config['channel']
 
-auth = tweepy.OAuthHandler(TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET)
-auth.set_access_token(TWITTER_ACCESS_TOKEN, TWITTER_ACCESS_TOKEN_SECRET)
-api = tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+# Metrics #####################################################################
+
+RECEIVED = metrics.counter('tweets_received_total', 'Payloads received from the stream')
+REJECTED = metrics.counter('tweets_rejected_total',
+                           'Tweets dropped, by the filter stage that dropped them',
+                           ('stage',))
+MATCHED = metrics.counter('tweets_matched_total', 'Tweets matching a routing rule')
+RENDERED = metrics.counter('tweets_rendered_total', 'Slack messages rendered')
+STAGE = metrics.histogram('stage_seconds', 'Time spent in each pipeline stage',
+                          ('stage',))
+# children looked up once, the hot path only calls observe()
+PREPROCESS_TIME = STAGE.labels('preprocess')
+FILTER_TIME = STAGE.labels('filter')
+ROUTE_TIME = STAGE.labels('route')
+RENDER_TIME = STAGE.labels('render')
+
+_api = None
+
+def get_api():
+    """
+    Authenticate with Twitter on first use so the filtering code
+    can be imported (e.g. by replay.py) without credentials
+    """
+    global _api
+    if _api is None:
+        auth = tweepy.OAuthHandler(os.environ['TWITTER_CONSUMER_KEY'],
+                                   os.environ['TWITTER_CONSUMER_SECRET'])
+        auth.set_access_token(os.environ['TWITTER_ACCESS_TOKEN'],
+                              os.environ['TWITTER_ACCESS_TOKEN_SECRET'])
+        _api = tweepy.API(auth, wait_on_rate_limit=True,
+                          wait_on_rate_limit_notify=True)
+    return _api
+
+_stream_auths = None
+
+def stream_auths():
+    """
+    Credentials for each stream connection, Twitter allows one filter
+    stream per account: the TWITTER_* variables for the first, then
+    TWITTER_ACCESS_TOKEN_1 and TWITTER_ACCESS_TOKEN_SECRET_1 for the
+    second and so on (TWITTER_CONSUMER_KEY_1... default to the app's)
+    """
+    global _stream_auths
+    if _stream_auths is None:
+        auths = [get_api().auth]
+        env = os.environ
+        while env.get('TWITTER_ACCESS_TOKEN_{}'.format(len(auths))):
+            n = len(auths)
+            auth = tweepy.OAuthHandler(
+                env.get('TWITTER_CONSUMER_KEY_{}'.format(n), env['TWITTER_CONSUMER_KEY']),
+                env.get('TWITTER_CONSUMER_SECRET_{}'.format(n), env['TWITTER_CONSUMER_SECRET']))
+            auth.set_access_token(env['TWITTER_ACCESS_TOKEN_{}'.format(n)],
+                                  env['TWITTER_ACCESS_TOKEN_SECRET_{}'.format(n)])
+            auths.append(auth)
+        _stream_auths = auths
+    return _stream_auths
 
 # Create custom Classes #######################################################
 
@@ -47,210 +103,356 @@ class CustTweepyStream(Stream):
     def finalize(self):
         pass
 
+    def on_closed(self, resp):
+        # tweepy would reconnect straight away without any backoff,
+        # end the connection and let the supervisor reconnect
+        self.running = False
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.finalize()
 
     def __enter__(self):
         return self
 
-# Brute force filtering functions #############################################
-def filter_tweets_by_word(status):
-    """Brute-force search"""
-    flag = False
-
-    # search tweet text
-    for word in db.get_keywords():
-        for w in status.text.split():
-            if word == w:
-                flag = True
-    # search quote tweet text
-    if hasattr(status, "quoted_status"):
-        for word in db.get_keywords():
-            for w in status.quoted_status.text.split():
-                if word == w:
-                    flag = True
-    # search retweet text
-    if hasattr(status, "retweeted_status"):
-        for word in db.get_keywords():
-            for w in status.retweeted_status.text.split():
-                if word == w:
-                    flag = True
-    return flag
-
-def filter_tweets_by_user(twitter_user):
-    """Brute-force search"""
-    flag = False
-    for user in db.get_users():
-        if user == '@' + str(twitter_user):
-            flag = True
-    return flag
-###############################################################################
-
 def preprocess_text(status):
     """
     convert extended tweets text and full text tweets
-    to something our template can handle
+    to something our template can handle: a compact TweetRecord
+    built from a tweepy Status or a decoded stream payload
     """
-    if hasattr(status, "full_text"):
-        status.text = status.full_text
-    if hasattr(status, "extended_tweet"):
-        status.text = status.extended_tweet["full_text"]
-    if hasattr(status, "quoted_status"):
-        if hasattr(status.quoted_status, "full_text"):
-            status.quoted_status.text = status.quoted_status.full_text
-    if hasattr(status, "retweeted_status"):
-        if hasattr(status.retweeted_status, "full_text"):
-            status.retweeted_status.text = status.retweeted_status.full_text
-    return status
+    if isinstance(status, dict):
+        return record.TweetRecord.from_dict(status)
+    return record.TweetRecord.from_status(status)
+
+def new_queue():
+    """Create a bounded tweet queue using the overflow policy in config.yaml"""
+    return tweetqueue.TweetQueue(maxsize=config.get('queue_size', 10000),
+                                 policy=config.get('queue_policy', 'drop-oldest'),
+                                 spill_file=config.get('queue_spill_file'),
+                                 dump=record.TweetRecord.to_json,
+                                 load=record.TweetRecord.from_json)
 
 #override tweepy.StreamListener to add logic to on_status
 class MyStreamListener(tweepy.StreamListener):
 
-    def __init__(self, channel='bot-dev', q=Queue()):
+    def __init__(self, channel='bot-dev', q=None, sender=None):
         super(MyStreamListener,self).__init__()
         self.channel = channel
-
-        # create a queue for tweet data
-        num_worker_threads = 4
-        self.q = q
-        for i in range(num_worker_threads):
-            t = Thread(target=self.process_status)
-            t.daemon = True
-            t.start()
-        
-    def on_status(self, status):
-        #store status in the queue
-        self.q.put(status)
+        # posts are handed off to the async delivery stage
+        self.sender = sender or slack.get_sender()
+        self.follow_ids = frozenset()
+        self.dedup = dedup.get_cache()
+        # with several stream connections the same tweet can arrive twice,
+        # e.g. an account retweeting another followed on a different shard
+        self.stream_seen = dedup.DedupCache(
+            window=config.get('stream_dedup_window', 600),
+            capacity=config.get('stream_dedup_capacity', 20000))
+        # newest status seen per followed account, for gap backfill
+        self.checkpoints = backfill.get_checkpoints()
+        # with filter_processes set, tweets are filtered in worker processes
+        self.filters = None
+        self.reload_rules()
+        if config.get('filter_processes', 0):
+            self.filters = filterpool.FilterPool(
+                self.post_match,
+                processes=config['filter_processes'],
+                channel=channel,
+                batch_size=config.get('filter_batch_size', 50)).start()
+
+        # create a queue for tweet data, owned by this listener
+        self.q = q if q is not None else new_queue()
+        self.pool = workers.WorkerPool(self.process_status, self.q,
+                                       min_workers=config.get('min_workers', 2),
+                                       max_workers=config.get('max_workers', 8),
+                                       name='tweet-worker').start()
+        metrics.gauge('tweet_queue_depth', 'Tweets waiting for a filter worker',
+                      fn=self.q.qsize)
+        metrics.gauge('tweet_workers', 'Filter worker threads',
+                      fn=lambda: self.pool.size)
+
+    def stop(self, timeout=10):
+        """
+        Finish the tweets already accepted, waiting up to timeout for the
+        queue to drain, then stop the worker pool. Stop the streams first
+        """
+        if self.filters is not None and not self.filters.stop(timeout):
+            logging.warning("Filter processes still busy after %ss", timeout)
+        logging.info("Stopping with %d tweets queued", self.q.qsize())
+        if not self.pool.drain(timeout):
+            logging.warning("%d tweets still queued after %ss, they won't be processed",
+                            self.q.qsize(), timeout)
+        self.pool.stop()
+        if not self.pool.join(timeout):
+            logging.warning("Tweet workers still busy after %ss", timeout)
+        self.dedup.save()
+        self.checkpoints.save()
+
+    def reload_rules(self):
+        """Swap in a router for the current users/keywords/routes without reconnecting"""
+        # single attribute assignments so workers see the old or new index
+        router = routing.get_router(self.channel)
+        self.router = router
+        # the fast path can only reject on keywords if every rule needs one
+        self.keyword_matcher = None if router.any_keyword else router.matcher
+        if self.filters is not None:
+            self.filters.reload()
+        logging.info("Loaded %d routing rules", len(router.rules))
+
+    def on_data(self, raw_data):
+        """
+        Fast path: decode the payload once and drop tweets from other
+        users, replies and keyword misses before tweepy builds a Status
+        """
+        RECEIVED.inc()
+        data = ingest.loads(raw_data)
+        if not ingest.is_tweet(data):
+            # deletes, limits, warnings etc. are rare, let tweepy handle them
+            return super(MyStreamListener, self).on_data(raw_data)
+        return self.ingest(data, raw_data)
+
+    def ingest(self, data, raw_data=None):
+        """
+        Filter a decoded tweet payload from the stream and queue it,
+        raw_data is the payload as received if there is one
+        """
+        tweet = self._accept(data, raw_data)
+        if tweet is not None:
+            self.q.put(tweet)
         return True
 
-    def process_status(self):
-        """Handle tweet data"""
-        # return false to stop the stream and close the connection
-        while True:
-
-            status = self.q.get()
-
-            try:
-                logging.info("Got a tweet!")
-                
-                status = preprocess_text(status)
-                    
-                # parse for authors
-                if filter_tweets_by_user(status.user.screen_name):
-                    logging.info("found an author match")
-                    # parse for keywords
-                    if filter_tweets_by_word(status):
-                        logging.info("found a text match!")
-                        # filter out reply tweets
-                        if status.in_reply_to_status_id == None:
-                            slack.write_block(slack.build_message(status), 
-                                        user_icon=status.user.profile_image_url, 
-                                        channel=self.channel)
-
-            # Check for an error Tweepy encounters every ~1 day or so.
-            # This is likely caused by the process_status function falling 
-            # behind the stream and should be fixed with the use of a queue 
-            # but we can still check for these errors for now.
-
-            # https://github.com/tweepy/tweepy/issues/908
-            # https://github.com/tweepy/tweepy/issues/237
-            except BaseException as e:
-                logging.error("Error on_data: %s, Pausing..." % str(e))
-                time.sleep(5)
-                continue
+    def backfill(self, data):
+        """
+        Filter and process a backfilled tweet payload in the calling
+        thread, so tweets handed over oldest first are posted in that
+        order. With filter_processes only each author's order is kept
+        """
+        tweet = self._accept(data)
+        if tweet is not None:
+            self.process_status(tweet)
+
+    def _accept(self, data, raw_data=None):
+        """The TweetRecord for a payload that passes the filters, else None"""
+        clock = time.perf_counter
+        start = clock()
+        author = ingest.author_id(data)
+        if author not in self.follow_ids:
+            REJECTED.labels('user').inc()
+            return None
+        status = ingest.status_id(data)
+        self.checkpoints.update(author, status)
+        if self.stream_seen.seen(status):
+            REJECTED.labels('stream_duplicate').inc()
+            return None
+        if self.filters is not None:
+            # the workers do the rest
+            if raw_data is None:
+                raw_data = json.dumps(data)
+            self.filters.submit(raw_data, author)
+            return None
+        reason = ingest.content_reject_reason(data, self.keyword_matcher)
+        filtered = clock()
+        FILTER_TIME.observe(filtered - start)
+        if reason is not None:
+            REJECTED.labels(reason).inc()
+            return None
+        # only the compact record crosses the queue
+        tweet = preprocess_text(data)
+        PREPROCESS_TIME.observe(clock() - filtered)
+        return tweet
 
-            except http_incompleteRead as e:
-                logging.error("http.client Incomplete Read error: %s" % str(e))
-                logging.error("~~~ Restarting stream search in 5 seconds... ~~~")
-                time.sleep(5)
-                continue
+    def on_status(self, status):
+        #store status in the queue, this never blocks the stream reader
+        start = time.perf_counter()
+        tweet = preprocess_text(status)
+        PREPROCESS_TIME.observe(time.perf_counter() - start)
+        self.q.put(tweet)
+        return True
 
-            except urllib3_incompleteRead as e:
-                logging.error("urllib3 Incomplete Read error: %s" % str(e))
-                logging.error("~~~ Restarting stream search in 5 seconds... ~~~")
-                time.sleep(5)
-                continue
+    def process_status(self, tweet):
+        """Handle a queued TweetRecord, called by the worker pool"""
+        try:
+            logging.debug("Got a tweet!")
+
+            # filter out reply tweets
+            if tweet.reply_to != None:
+                REJECTED.labels('reply').inc()
+                return True
+
+            # one pass over authors and keywords for every routing rule
+            start = time.perf_counter()
+            channels = self.router.route(tweet)
+            ROUTE_TIME.observe(time.perf_counter() - start)
+            if not channels:
+                REJECTED.labels('route').inc()
+            else:
+                self.post_match(channels, tweet.canonical_id,
+                                lambda: slack.build_message(tweet),
+                                tweet.user_icon)
+
+        # Check for an error Tweepy encounters every ~1 day or so.
+        # This is likely caused by the process_status function falling 
+        # behind the stream and should be fixed with the use of a queue 
+        # but we can still check for these errors for now.
+
+        # https://github.com/tweepy/tweepy/issues/908
+        # https://github.com/tweepy/tweepy/issues/237
+        except BaseException as e:
+            logging.error("Error on_data: %s, Pausing...", e)
+            time.sleep(5)
+            return False
+
+        except http_incompleteRead as e:
+            logging.error("http.client Incomplete Read error: %s", e)
+            logging.error("~~~ Restarting stream search in 5 seconds... ~~~")
+            time.sleep(5)
+            return False
+
+        except urllib3_incompleteRead as e:
+            logging.error("urllib3 Incomplete Read error: %s", e)
+            logging.error("~~~ Restarting stream search in 5 seconds... ~~~")
+            time.sleep(5)
+            return False
 
-        self.q.task_done()
         return True
 
-    def on_error(self, status_code):
-        """Handle HTTP errors from Twitter"""
-        with self.q.mutex: # thread safe
-            # clear the queue on error
-            self.q.clear()
-        logging.error("Recieved error code: {}".format(status_code))
-        if status_code == 420:
-            # request rate limit
-            logging.warning("API rate limited!! Waiting 60s and will try to restart")
-            time.sleep(60)
-            bot_stream = launch_bot()
-
-            for changes in watch(os.path.abspath('.'), watcher_cls=CSVWatcher):
-                print(changes)
-                bot_stream = restart_bot(bot_stream)
-
+    def post_match(self, channels, canonical_id, blocks, user_icon):
+        """
+        Hand a matched tweet to the sender for every channel it hasn't
+        been posted to yet. blocks is the rendered message, or a function
+        rendering it so tweets that are all duplicates are never rendered.
+        """
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("found a match for %s", ', '.join(channels))
+        MATCHED.inc()
+        for channel in channels:
+            # skip statuses we already posted to this channel
+            if self.dedup.seen('{}:{}'.format(channel, canonical_id)):
+                REJECTED.labels('duplicate').inc()
+                continue
+            if callable(blocks):
+                start = time.perf_counter()
+                blocks = blocks()
+                RENDER_TIME.observe(time.perf_counter() - start)
+                RENDERED.inc()
+            self.sender.submit(blocks, 
+                        user_icon=user_icon, 
+                        channel=channel)
+
+    def on_disconnect(self, notice):
+        """Twitter's reason for closing the stream, the supervisor reconnects"""
+        logging.warning("Stream disconnect notice: %s", notice)
         return False
 
+# persistent handle -> id cache so restarts only resolve new handles
+id_cache = lookup.IdCache()
+
 def get_ids():
     """Helper to get Twitter id numbers from user handles"""
     users = db.get_users()
-    ids = []
-    for user in users:
-        ids.append(str(api.get_user(screen_name = user).id))
-    return ids
-
-def launch_bot(channel=POST_CHANNEL):
+    # accounts only followed by a routing rule need to be on the stream too
+    users += sorted(routing.get_router().users - set(users))
+    return lookup.resolve_ids(users, get_api(), id_cache)
+
+def new_stream(listener, shard=0):
+    """An unconnected stream feeding listener, the supervisor connects it"""
+    return CustTweepyStream(auth = stream_auths()[shard], 
+                            listener=listener, 
+                            include_entities=True, 
+                            tweet_mode = 'extended')
+
+def launch_bot(channel=POST_CHANNEL, q=None):
     """
     Start the stream and filter for users in the db list.
-    All other filtering is done by the Listener.
+    All other filtering is done by the Listener, `q` carries
+    tweets over from a previous listener. Returns the stream
+    manager, which keeps the stream connections up, and the listener.
     """
     logging.info("Creating listener...")
-    myStreamListener = MyStreamListener(channel=channel)
-    myStream = CustTweepyStream(auth = api.auth, 
-                                listener=myStreamListener, 
-                                include_entities=True, 
-                                tweet_mode = 'extended')
+    myStreamListener = MyStreamListener(channel=channel, q=q)
+    ids = get_ids()
+    # set before connecting, the on_data fast path checks authors against it
+    myStreamListener.follow_ids = frozenset(ids)
+
+    # fetch what was missed while a stream was down
+    hooks = {}
+    if config.get('backfill', True):
+        backfiller = backfill.Backfiller(
+            get_api(), myStreamListener.backfill, myStreamListener.checkpoints,
+            workers=config.get('backfill_workers', 8),
+            rate=config.get('backfill_rate', 0.66),
+            burst=config.get('backfill_burst', 300),
+            max_age=config.get('backfill_max_age', 3600),
+            window_calls=config.get('backfill_window_calls', backfill.TIMELINE_LIMIT))
+        hooks = {'on_lost': backfiller.lost, 'on_recovered': backfiller.recovered}
+
+    connections = config.get('stream_connections', 1)
+    if connections > len(stream_auths()):
+        # connections sharing an account would keep disconnecting each other
+        logging.error("stream_connections is %d but only %d sets of Twitter credentials "
+                      "are set, using %d connections", connections,
+                      len(stream_auths()), len(stream_auths()))
+        connections = len(stream_auths())
 
-    # start filtering
     logging.info("Starting bot...")
-    # async needs to be true so we don't block the file watcher
-    # stall_warnings for when the tweets come too fast
-    myStream.filter(follow=get_ids(), is_async=True, stall_warnings=False)
+    # the streams run in their own threads so we don't block the file watcher
+    bot_streams = supervisor.StreamManager(
+        myStreamListener, new_stream, ids,
+        connections=connections,
+        follow_limit=config.get('stream_follow_limit', 5000),
+        stable_after=config.get('reconnect_stable_after', 30),
+        jitter=config.get('reconnect_jitter', 0.2), **hooks).start()
 
-    return myStream, myStreamListener
+    return bot_streams, myStreamListener
 
-def restart_bot(stream, listener):
-    # try to kill previous stream
+def reload_filters(bot_streams, listener, changed):
+    """
+    Apply user/keyword/route changes to a running bot. `changed` is
+    the set of kinds that changed ('users', 'keywords', 'routes').
+    The rules are swapped into the listener, user changes
+    only reconnect the streams whose followed ids differ.
+    """
+    for kind in changed:
+        db.invalidate(db.source(kind))
+
+    if changed:
+        listener.reload_rules()
+
+    if changed & {'users', 'routes'}:
+        ids = get_ids()
+        if frozenset(ids) != listener.follow_ids:
+            listener.follow_ids = frozenset(ids)
+            shards = bot_streams.reconnect(ids)
+            logging.info("Follow list changed, reconnected stream shards %s", shards)
+        else:
+            logging.info("Follow list unchanged, keeping stream")
 
-    logging.info("Restarting bot stream!")
+    return bot_streams, listener
 
-    # https://stackoverflow.com/questions/38560760/python-clear-items-from-priorityqueue
-    # clear the queue on error
-    logging.info("Killing threads..")
-    # with listener.q.mutex: # thread safe never seemed to work
-    while not listener.q.empty():
-        print("in loop")
-        try:
-            listener.q.get(block=False,timeout=1.0)
-        except:
-            continue
-    listener.q.task_done()
-    logging.info("Disconnecting from stream")
-    stream.disconnect()
-    # return a new stream but wait some time to avoid rate limiting
-    logging.info("Waiting 60s to reconnect...")
-    time.sleep(60)
-    return launch_bot()
+def watch_changes():
+    """Yield sets of changed kinds, from the CSV files or the database version"""
+    if db.storage == 'sqlite':
+        yield from db.watch_changes()
+    else:
+        for changes in watch(os.path.abspath('.'), watcher_cls=CSVWatcher):
+            changed = db.kinds_for_paths(path for _, path in changes)
+            if changed:
+                yield changed
 
 if __name__ == '__main__':
     dev_mode = False # see file changes
-    # run the bot watching for file changes using CSVWatcher
-    bot_stream, bot_listener = launch_bot()
-
-    for changes in watch(os.path.abspath('.'), watcher_cls=CSVWatcher):
-        if dev_mode:
-            print(changes)
-            bot_stream, bot_listener = restart_bot(bot_stream, bot_listener)
-        else:
-            bot_stream, bot_listener = restart_bot(bot_stream, bot_listener)
+    if config.get('metrics_port'):
+        metrics.start_server(config['metrics_port'],
+                             config.get('metrics_host', '127.0.0.1'))
+    # run the bot watching for user/keyword/route changes
+    bot_streams, bot_listener = launch_bot()
+
+    try:
+        for changed in watch_changes():
+            if dev_mode:
+                print(changed)
+            bot_streams, bot_listener = reload_filters(bot_streams, bot_listener, changed)
+    finally:
+        # deliver anything already matched before exiting
+        bot_streams.stop()
+        bot_listener.stop(timeout=config.get('shutdown_timeout', 30))
+        slack.get_sender().close(timeout=config.get('shutdown_timeout', 30))
@@ -27,7 +27,7 @@ data = {
             "type": "section",
             "text": {
                 "type": "mrkdwn",
-                "text": "These are the avaliable TwitterBot commands:\n>`/users` view accounts I'm following \n>`/keywords` view keywords I'm searching for\n>`/add_user` add a Twitter account\n>`/add_keyword` add a keyword to search for\n>`/remove_user` remove a Twitter account\n>`/remove_keyword` remove a keyword search term\n>`/help` print help"
+                "text": "These are the avaliable TwitterBot commands:\n>`/users` view accounts I'm following \n>`/keywords` view keywords I'm searching for\n>`/add_user` add a Twitter account\n>`/add_keyword` add a keyword or query to search for, e.g. `/add_keyword \"deep learning\" OR #AI -hiring`\n>`/remove_user` remove a Twitter account\n>`/remove_keyword` remove a keyword search term\n>`/routes` view channel routing rules\n>`/add_route` send matches for `@users` and keywords to a channel, e.g. `/add_route #ml @GoogleAI \"machine learning\"`. Each keyword is a word or a \"phrase\", put a query in single quotes: `'\"deep learning\" -hiring'`\n>`/remove_route` remove the routing rules for a channel\n>`/help` print help"
             }
         }
     ]
@@ -0,0 +1,121 @@
+import time
+from threading import Event, Lock, Thread, current_thread
+import logging
+
+# Worker pool #################################################################
+# Runs `handler(item)` for everything taken off a TweetQueue. The pool keeps
+# between min_workers and max_workers threads. A monitor thread adds a
+# worker when the estimated time to drain the queue (depth x average
+# handler latency / workers) goes over `target_delay`, and retires one after
+# the queue has been idle for `idle_checks` checks in a row.
+
+class WorkerPool:
+    """Resizable pool of threads consuming a queue"""
+
+    def __init__(self, handler, q, min_workers=2, max_workers=8,
+                 target_delay=1.0, interval=1.0, idle_checks=5, name='worker'):
+        self.handler = handler
+        self.q = q
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.target_delay = target_delay
+        self.interval = interval
+        self.idle_checks = idle_checks
+        self.name = name
+        self.stopping = Event()
+        self.lock = Lock()
+        self.threads = []
+        self._retire = 0
+        self._idle = 0
+        self._monitor = None
+        # exponentially weighted average handler time in seconds
+        self.latency = 0.0
+        self.processed = 0
+
+    @property
+    def size(self):
+        with self.lock:
+            return len(self.threads)
+
+    def start(self):
+        for i in range(self.min_workers):
+            self._add_worker()
+        self._monitor = Thread(target=self._autoscale, daemon=True,
+                               name=self.name + '-monitor')
+        self._monitor.start()
+        return self
+
+    def stop(self):
+        """Ask every worker to exit once its current item is finished"""
+        self.stopping.set()
+
+    def drain(self, timeout=None):
+        """Wait for the queue to empty, returns True if it did in time"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.q.qsize():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def join(self, timeout=None):
+        """Wait for the workers to exit, returns True if they all did"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for t in list(self.threads) + [self._monitor]:
+            if t is None:
+                continue
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            t.join(remaining)
+        return not any(t.is_alive() for t in self.threads)
+
+    def _add_worker(self):
+        with self.lock:
+            t = Thread(target=self._work, daemon=True,
+                       name='{}-{}'.format(self.name, len(self.threads)))
+            self.threads.append(t)
+        t.start()
+
+    def _should_retire(self):
+        with self.lock:
+            if self._retire and len(self.threads) > self.min_workers:
+                self._retire -= 1
+                self.threads.remove(current_thread())
+                return True
+        return False
+
+    def _work(self):
+        while not self.stopping.is_set():
+            if self._should_retire():
+                return
+            # wake up regularly so stop() and retirement are noticed
+            item = self.q.get(timeout=self.interval)
+            if item is None:
+                continue
+            start = time.perf_counter()
+            try:
+                self.handler(item)
+            except Exception as e:
+                logging.error("Unhandled error in %s: %s", self.name, e)
+            elapsed = time.perf_counter() - start
+            self.latency += 0.1 * (elapsed - self.latency)
+            self.processed += 1
+
+    def _autoscale(self):
+        while not self.stopping.wait(self.interval):
+            depth = self.q.qsize()
+            workers = self.size
+            # with min_workers 0 the pool can be empty, then any depth needs one
+            if depth and workers < self.max_workers and \
+                    (not workers or depth * self.latency / workers > self.target_delay):
+                logging.info("Queue depth %d, adding a %s", depth, self.name)
+                self._add_worker()
+                self._idle = 0
+            elif depth == 0:
+                self._idle += 1
+                if self._idle >= self.idle_checks and workers > self.min_workers:
+                    logging.info("Queue idle, retiring a %s", self.name)
+                    with self.lock:
+                        self._retire += 1
+                    self._idle = 0
+            else:
+                self._idle = 0